@@ -1,17 +1,28 @@
+import asyncio
+import os
+from collections import defaultdict
 from langgraph.graph import StateGraph, START, END
 from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
-from langchain_core.messages import SystemMessage
 import aiosqlite
 from dotenv import load_dotenv
 
 from state import State
 from nodes import generate_draft, critique_draft, generate_final, mentor
-from store import ensure_metadata_table, save_thread_title, get_all_threads, delete_thread, delete_all_threads
-from profile import ensure_profile_table
-from llm import llm
+from store import ensure_metadata_table, ensure_search_index, index_thread_messages, get_unindexed_threads, get_all_threads
+from deletion import delete_thread, delete_all_threads, schedule_purge, stop_purge
+from profile import ensure_profile_table, flush_profile_writes
+from blobs import ensure_blob_table
+from journal import ensure_journal_table, ensure_lease_table, stop_journals, acquire_lease, release_lease
+from titles import update_thread_title, stop_title_worker
+from shards import DEFAULT_USER_ID, db_path_for, existing_db_paths
+from utils import map_from_langchain_messages
 
 load_dotenv()
 
+# With `uvicorn --workers N` every worker starts the startup jobs; the lease lets
+# one of them do the work. It expires on its own if that worker dies.
+STARTUP_JOBS_LEASE = 600  # seconds
+
 # --- Graph Construction ---
 
 def should_continue(state: State):
@@ -47,63 +58,95 @@ builder.add_edge("mentor", END)
 # AsyncSqliteSaver from langgraph.checkpoint.sqlite.aio expects an initialized aiosqlite connection
 # We use from_conn_string to manage connection properly
 
-# We export builder and a function to initialize the graph with checkpointer
-compiled_graph = None
-saver_context = None
-
-async def get_graph():
-    global compiled_graph, saver_context
-    if compiled_graph is None:
-        # Ensure metadata table exists
-        await ensure_metadata_table()
-        # Ensure profile table exists
-        await ensure_profile_table()
-        
-        # Use from_conn_string to manage connection properly
-        saver_context = AsyncSqliteSaver.from_conn_string("checkpoints.db")
-        memory = await saver_context.__aenter__()
-        compiled_graph = builder.compile(checkpointer=memory)
-    return compiled_graph
+# We export builder and a function to initialize the graph with checkpointer.
+# Checkpoints live in the caller's shard file (see shards.py), so there is one
+# compiled graph and saver per shard.
+compiled_graphs = {}  # db_path -> compiled graph
+saver_contexts = {}  # db_path -> AsyncSqliteSaver context
+# One lock per shard, so opening a new shard does not hold up requests for others
+_graph_locks = defaultdict(asyncio.Lock)  # db_path -> lock
+
+async def get_graph(user_id: str = DEFAULT_USER_ID):
+    return await _shard_graph(db_path_for(user_id))
+
+async def _shard_graph(db_path: str):
+    if db_path not in compiled_graphs:
+        async with _graph_locks[db_path]:
+            if db_path not in compiled_graphs:
+                compiled_graphs[db_path] = await _open_graph(db_path)
+    return compiled_graphs[db_path]
+
+async def _open_graph(db_path: str):
+    if os.path.dirname(db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    # Ensure metadata table exists
+    await ensure_metadata_table(db_path)
+    # Ensure profile table exists
+    await ensure_profile_table(db_path)
+    # Ensure full-text search index exists
+    await ensure_search_index(db_path)
+    # Ensure content-addressed search result storage exists
+    await ensure_blob_table(db_path)
+    # Ensure the turn registry and SSE event spillover tables exist
+    await ensure_journal_table(db_path)
+
+    # Use from_conn_string to manage connection properly
+    saver_context = AsyncSqliteSaver.from_conn_string(db_path)
+    memory = await saver_context.__aenter__()
+    # Create the checkpoint tables now, the purge and listing queries expect them
+    await memory.setup()
+    saver_contexts[db_path] = saver_context
+    return builder.compile(checkpointer=memory)
 
 async def cleanup_graph():
-    global saver_context
-    if saver_context:
+    await stop_journals()
+    await stop_purge()
+    await stop_title_worker()
+    await flush_profile_writes()
+    for saver_context in saver_contexts.values():
         await saver_context.__aexit__(None, None, None)
+    saver_contexts.clear()
+    compiled_graphs.clear()
 
-async def summarize_thread(thread_id: str):
-    # Retrieve messages
-    graph = await get_graph()
+async def finish_turn(user_id: str, thread_id: str):
+    """Post-turn bookkeeping: thread title and full-text search index."""
+    graph = await get_graph(user_id)
     state = await graph.aget_state({"configurable": {"thread_id": thread_id}})
     if not state.values or "messages" not in state.values:
         return
-        
     messages = state.values["messages"]
-    if not messages:
-        return
-        
-    # Format messages for summarization
-    # We take the last few exchanges or all of them?
-    # For a title, the first few messages or the general topic is usually enough.
-    # But if the topic changes, we want the LATEST topic.
-    # The user said "Every Q&A update", so it should reflect the current state.
-    # Let's feed the whole history (truncated if too long) to the LLM.
-    
-    # Simple text representation
-    history_text = "\n".join([f"{m.type}: {m.content}" for m in messages[-10:]]) # last 10 messages
-    
-    prompt = f"""
-    请根据以下对话内容，生成一个简短的标题（不超过 10 个字）。
-    如果是中文对话，请使用中文标题。
-    不要包含“标题：”等前缀，直接输出标题内容。
-    
-    对话内容：
-    {history_text}
-    """
-    
+
+    # Titles are generated on the first exchange and regenerated only on topic drift;
+    # the LLM calls themselves are batched across threads in titles.py
+    await update_thread_title(user_id, thread_id, messages)
     try:
-        # Use a separate invocation to avoid messing with the graph state
-        response = await llm.ainvoke([SystemMessage(content=prompt)])
-        title = response.content.strip().replace('"', '').replace("'", "")
-        await save_thread_title(thread_id, title)
+        await index_thread_messages(db_path_for(user_id), thread_id, map_from_langchain_messages(messages))
     except Exception as e:
-        print(f"Error generating title: {e}")
+        print(f"Error indexing thread {thread_id}: {e}")
+
+async def start_background_jobs():
+    # For every existing shard: resume purges interrupted by a restart,
+    # then index threads for /chat/search
+    await get_graph()
+    await ensure_lease_table()
+    if not await acquire_lease("startup_jobs", STARTUP_JOBS_LEASE):
+        return
+    try:
+        for db_path in existing_db_paths():
+            await _shard_graph(db_path)
+            schedule_purge(db_path)
+            await backfill_search_index(db_path)
+    finally:
+        await release_lease("startup_jobs")
+
+async def backfill_search_index(db_path: str):
+    """Index threads created before the search index existed."""
+    graph = await _shard_graph(db_path)
+    for thread_id in await get_unindexed_threads(db_path):
+        try:
+            state = await graph.aget_state({"configurable": {"thread_id": thread_id}})
+            if state.values and "messages" in state.values:
+                messages = map_from_langchain_messages(state.values["messages"])
+                await index_thread_messages(db_path, thread_id, messages, created_at=state.created_at)
+        except Exception as e:
+            print(f"Error backfilling search index for {thread_id}: {e}")
@@ -0,0 +1,58 @@
+import hashlib
+import json
+import re
+import time
+from collections import OrderedDict
+
+from llm import PROMPTS_VERSION
+from profile import get_relevant_profile
+
+# Exact-match cache for first-turn answers (e.g. "what is a Python decorator").
+# Keys combine the normalized question, a fingerprint of the knowledge categories
+# the prompts would select, and the prompts.yaml version, so any of them changing is a miss.
+ANSWER_CACHE_SIZE = 256
+ANSWER_CACHE_TTL = 24 * 3600  # seconds
+
+_TRAILING_PUNCTUATION = "?？!！.。~～ "
+
+class AnswerCache:
+    def __init__(self, max_size: int = ANSWER_CACHE_SIZE, ttl: float = ANSWER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, answer)
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, answer = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return answer
+
+    def put(self, key: str, answer: str):
+        self.entries[key] = (time.monotonic() + self.ttl, answer)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+def normalize_question(text: str) -> str:
+    text = re.sub(r"\s+", " ", text).strip().lower()
+    return text.rstrip(_TRAILING_PUNCTUATION)
+
+def profile_fingerprint(knowledge) -> str:
+    encoded = json.dumps(knowledge, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+async def answer_cache_key(user_id: str, question: str) -> str:
+    # Same selection the coach prompts use, so unrelated profile changes still hit.
+    # learning_goals and self_description are left out: the mentor rewrites them
+    # on most turns, which would invalidate every entry right after it is stored.
+    # user_id is part of the key so identical profiles of two users never share answers.
+    profile = await get_relevant_profile(user_id, question)
+    parts = [user_id, normalize_question(question), profile_fingerprint(profile["knowledge"]), PROMPTS_VERSION]
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+answer_cache = AnswerCache()
@@ -0,0 +1,67 @@
+import hashlib
+import zlib
+import aiosqlite
+
+from shards import db_path_for
+
+# Search payloads are stored once here, keyed by the sha256 of their text.
+# Graph state only carries the hashes, so checkpoints stay small.
+# search_blob_refs records which threads use a blob, so deleting a thread can
+# free the blobs nothing else references (see store.release_thread_blobs).
+
+async def ensure_blob_table(db_path: str):
+    async with aiosqlite.connect(db_path) as db:
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS search_blobs (
+                hash TEXT PRIMARY KEY,
+                data BLOB,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS search_blob_refs (
+                hash TEXT NOT NULL,
+                thread_id TEXT NOT NULL,
+                PRIMARY KEY (hash, thread_id)
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_search_blob_refs_thread ON search_blob_refs (thread_id)")
+        await db.commit()
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+async def put_blobs(user_id: str, texts, thread_id: str = None):
+    """Store texts (deduplicated by content) used by `thread_id` and return their hashes in order."""
+    hashes = [content_hash(t) for t in texts]
+    if texts:
+        async with aiosqlite.connect(db_path_for(user_id)) as db:
+            await db.executemany(
+                "INSERT OR IGNORE INTO search_blobs (hash, data) VALUES (?, ?)",
+                [(h, zlib.compress(t.encode("utf-8"))) for h, t in zip(hashes, texts)]
+            )
+            if thread_id:
+                await db.executemany(
+                    "INSERT OR IGNORE INTO search_blob_refs (hash, thread_id) VALUES (?, ?)",
+                    [(h, thread_id) for h in set(hashes)]
+                )
+            await db.commit()
+    return hashes
+
+async def get_blobs(user_id: str, hashes):
+    """Return {hash: text} for the hashes that exist."""
+    if not hashes:
+        return {}
+    async with aiosqlite.connect(db_path_for(user_id)) as db:
+        placeholders = ",".join("?" * len(hashes))
+        async with db.execute(f"SELECT hash, data FROM search_blobs WHERE hash IN ({placeholders})", list(hashes)) as cursor:
+            rows = await cursor.fetchall()
+    return {h: zlib.decompress(data).decode("utf-8") for h, data in rows}
+
+async def resolve_search_results(user_id: str, hashes) -> str:
+    """Expand State.search_results hashes back into the joined search text."""
+    if isinstance(hashes, str):
+        # Checkpoints written before search results were stored out of line
+        return hashes
+    blobs = await get_blobs(user_id, hashes or [])
+    return "\n\n".join(blobs[h] for h in hashes if h in blobs)
@@ -0,0 +1,92 @@
+import asyncio
+
+from store import (
+    count_thread_rows, delete_thread as delete_thread_rows, mark_threads_deleted, count_deleted_threads,
+    get_deleted_threads, purge_thread_batch, incremental_vacuum, clear_orphaned_blobs,
+    auto_vacuum_mode
+)
+from shards import db_path_for
+
+# Deleting a large thread (or all of them) in one transaction holds the SQLite
+# write lock long enough to stall every active chat. Instead threads are marked
+# deleted right away and a background job removes their rows in small batches,
+# committing (and so releasing the lock) between batches.
+DELETE_BATCH_SIZE = 500
+DELETE_BATCH_PAUSE = 0.05  # seconds between batches, lets checkpoint writes through
+LARGE_THREAD_ROWS = 1000  # single-thread deletes above this go through the background job
+VACUUM_PAGES = 256
+
+# One purge job per shard file, so a large delete only slows down its own shard
+deletion_progress = {}  # db_path -> progress dict
+_purge_tasks = {}  # db_path -> asyncio.Task
+
+def _new_progress():
+    return {
+        "running": False,
+        "pending_threads": 0,
+        "current_thread": None,
+        "rows_deleted": 0,
+    }
+
+async def get_deletion_progress(user_id: str):
+    # Shard-level progress names other users' threads, so only counts of the
+    # caller's own threads are reported
+    progress = deletion_progress.get(db_path_for(user_id)) or _new_progress()
+    return {
+        "running": progress["running"],
+        "pending_threads": await count_deleted_threads(user_id),
+    }
+
+async def delete_thread(user_id: str, thread_id: str):
+    if await count_thread_rows(user_id, thread_id, LARGE_THREAD_ROWS + 1) > LARGE_THREAD_ROWS:
+        await mark_threads_deleted(user_id, [thread_id])
+        schedule_purge(db_path_for(user_id))
+        return True
+    return await delete_thread_rows(user_id, thread_id)
+
+async def delete_all_threads(user_id: str):
+    await mark_threads_deleted(user_id)
+    schedule_purge(db_path_for(user_id))
+    return True
+
+def schedule_purge(db_path: str):
+    task = _purge_tasks.get(db_path)
+    if task is None or task.done():
+        _purge_tasks[db_path] = asyncio.create_task(_purge_deleted_threads(db_path))
+
+async def _purge_deleted_threads(db_path: str):
+    progress = deletion_progress.setdefault(db_path, _new_progress())
+    progress["running"] = True
+    try:
+        # incremental_vacuum is a no-op unless the file was created (or converted
+        # by maintenance.py) with auto_vacuum = INCREMENTAL
+        reclaim = await auto_vacuum_mode(db_path) == 2
+        while True:
+            thread_ids = await get_deleted_threads(db_path)
+            if not thread_ids:
+                break
+            for i, thread_id in enumerate(thread_ids):
+                progress["pending_threads"] = len(thread_ids) - i
+                progress["current_thread"] = thread_id
+                while True:
+                    removed = await purge_thread_batch(db_path, thread_id, DELETE_BATCH_SIZE)
+                    if not removed:
+                        break
+                    progress["rows_deleted"] += removed
+                    if reclaim:
+                        await incremental_vacuum(db_path, VACUUM_PAGES)
+                    await asyncio.sleep(DELETE_BATCH_PAUSE)
+        await clear_orphaned_blobs(db_path)
+        if reclaim:
+            await incremental_vacuum(db_path, VACUUM_PAGES)
+    except Exception as e:
+        print(f"Error purging deleted threads in {db_path}: {e}")
+    finally:
+        progress["running"] = False
+        progress["pending_threads"] = 0
+        progress["current_thread"] = None
+
+async def stop_purge():
+    for task in _purge_tasks.values():
+        if not task.done():
+            task.cancel()
@@ -0,0 +1,242 @@
+import asyncio
+import os
+import time
+import aiosqlite
+
+from shards import db_path_for
+
+# Each streaming turn runs detached from its HTTP connection and writes its SSE
+# payloads into a TurnJournal. Clients (re)connect and replay from Last-Event-ID.
+# The turn registry and spilled events live in the user's shard (see shards.py),
+# so turns of users on different shards never write to the same file.
+
+# Process coordination only (leases), shared by all worker processes
+LEASE_DB_PATH = "journal.db"
+# Events kept in memory per turn; older ones spill over to SQLite
+JOURNAL_MEMORY_EVENTS = 500
+# Seconds a finished turn stays available for reconnects
+JOURNAL_TTL = 600
+# Spilled rows older than this were left behind by a process that exited mid-turn
+JOURNAL_STALE_AFTER = 3600
+# Seconds a turn_id is remembered after its journal is gone, so a late retry
+# is refused instead of running the pipeline again
+TURN_RECORD_TTL = 7 * 24 * 3600
+
+_journals = {}  # (user_id, turn_id) -> TurnJournal
+
+async def ensure_journal_table(db_path: str):
+    async with aiosqlite.connect(db_path) as db:
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS turn_events (
+                turn_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                data TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (turn_id, seq)
+            )
+        """)
+        # Migration: several worker processes share a shard, so startup may only
+        # drop rows that are old enough to be orphaned, not everything
+        try:
+            await db.execute("SELECT created_at FROM turn_events LIMIT 1")
+        except aiosqlite.OperationalError:
+            await db.execute("DELETE FROM turn_events")
+            await db.execute("ALTER TABLE turn_events ADD COLUMN created_at TIMESTAMP")
+        await db.execute(
+            "DELETE FROM turn_events WHERE created_at IS NULL OR created_at < datetime('now', ?)",
+            (f"-{JOURNAL_STALE_AFTER} seconds",)
+        )
+        # Every turn_id started by this shard's users, shared by all worker processes
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS turns (
+                turn_id TEXT PRIMARY KEY,
+                thread_id TEXT,
+                user_id TEXT,
+                status TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        # Migration: turns are only visible to the user who started them
+        try:
+            await db.execute("SELECT user_id FROM turns LIMIT 1")
+        except aiosqlite.OperationalError:
+            await db.execute("ALTER TABLE turns ADD COLUMN user_id TEXT")
+        await db.execute(
+            "DELETE FROM turns WHERE created_at < datetime('now', ?)", (f"-{TURN_RECORD_TTL} seconds",)
+        )
+        await db.commit()
+
+async def ensure_lease_table():
+    async with aiosqlite.connect(LEASE_DB_PATH) as db:
+        # Named leases, so a job only one worker should run is not run by all of them
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                holder TEXT,
+                expires_at REAL
+            )
+        """)
+        await db.commit()
+
+class TurnJournal:
+    def __init__(self, turn_id: str, thread_id: str, user_id: str):
+        self.turn_id = turn_id
+        self.thread_id = thread_id
+        self.user_id = user_id  # only this user may replay the turn
+        self.db_path = db_path_for(user_id)
+        self.events = []  # (seq, data), the in-memory tail
+        self.last_seq = 0
+        self.spilled_seq = 0  # events up to this seq live in SQLite only
+        self.done = False
+        self.task = None
+        self._changed = asyncio.Condition()
+
+    async def append(self, data: str):
+        async with self._changed:
+            self.last_seq += 1
+            self.events.append((self.last_seq, data))
+            if len(self.events) > JOURNAL_MEMORY_EVENTS:
+                await self._spill()
+            self._changed.notify_all()
+
+    async def finish(self):
+        async with self._changed:
+            self.done = True
+            self._changed.notify_all()
+
+    async def _spill(self):
+        # Move the older half of the in-memory tail to SQLite in one transaction
+        cut = len(self.events) // 2
+        spilled, self.events = self.events[:cut], self.events[cut:]
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.executemany(
+                "INSERT OR REPLACE INTO turn_events (turn_id, seq, data, created_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
+                [(self.turn_id, seq, data) for seq, data in spilled]
+            )
+            await db.commit()
+        self.spilled_seq = spilled[-1][0]
+
+    async def replay(self, after_seq: int = 0):
+        """Yield (seq, data) for every event after `after_seq`, then follow live events."""
+        while True:
+            if after_seq < self.spilled_seq:
+                # The reader is behind the in-memory tail
+                for seq, data in await self._read_spilled(after_seq):
+                    yield seq, data
+                    after_seq = seq
+                continue
+
+            async with self._changed:
+                await self._changed.wait_for(
+                    lambda: self.done or self.last_seq > after_seq or after_seq < self.spilled_seq
+                )
+                if after_seq < self.spilled_seq:
+                    continue
+                pending = [(seq, data) for seq, data in self.events if seq > after_seq]
+                # No more appends (and so no more spills) once the turn is done
+                finished = self.done
+
+            for seq, data in pending:
+                yield seq, data
+                after_seq = seq
+            if finished:
+                return
+
+    async def _read_spilled(self, after_seq: int):
+        async with aiosqlite.connect(self.db_path) as db:
+            async with db.execute(
+                "SELECT seq, data FROM turn_events WHERE turn_id = ? AND seq > ? AND seq <= ? ORDER BY seq",
+                (self.turn_id, after_seq, self.spilled_seq)
+            ) as cursor:
+                return await cursor.fetchall()
+
+    async def discard(self):
+        if self.spilled_seq:
+            async with aiosqlite.connect(self.db_path) as db:
+                await db.execute("DELETE FROM turn_events WHERE turn_id = ?", (self.turn_id,))
+                await db.commit()
+
+async def acquire_lease(name: str, seconds: float) -> bool:
+    """Take the named lease unless another live process holds it. Expires after `seconds`."""
+    now = time.time()
+    async with aiosqlite.connect(LEASE_DB_PATH) as db:
+        cursor = await db.execute("""
+            INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+            WHERE leases.expires_at < ?
+        """, (name, str(os.getpid()), now + seconds, now))
+        await db.commit()
+        return cursor.rowcount == 1
+
+async def release_lease(name: str):
+    async with aiosqlite.connect(LEASE_DB_PATH) as db:
+        await db.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, str(os.getpid())))
+        await db.commit()
+
+def get_journal(turn_id: str, user_id: str):
+    """The turn's journal in this process, or None (also when another user started it)."""
+    return _journals.get((user_id, turn_id))
+
+async def register_turn(turn_id: str, thread_id: str, user_id: str):
+    """
+    Record a new turn_id. Returns None if it was new, otherwise the status of the
+    earlier turn ("running" or "done", possibly in another process), or
+    "foreign" if another user on the same shard started it.
+    """
+    async with aiosqlite.connect(db_path_for(user_id)) as db:
+        try:
+            await db.execute(
+                "INSERT INTO turns (turn_id, thread_id, user_id, status) VALUES (?, ?, ?, 'running')",
+                (turn_id, thread_id, user_id)
+            )
+            await db.commit()
+            return None
+        except aiosqlite.IntegrityError:
+            async with db.execute("SELECT status, user_id FROM turns WHERE turn_id = ?", (turn_id,)) as cursor:
+                status, owner = await cursor.fetchone()
+            return status if owner == user_id else "foreign"
+
+async def get_turn_status(turn_id: str, user_id: str):
+    async with aiosqlite.connect(db_path_for(user_id)) as db:
+        async with db.execute(
+            "SELECT status FROM turns WHERE turn_id = ? AND user_id = ?", (turn_id, user_id)
+        ) as cursor:
+            row = await cursor.fetchone()
+    return row[0] if row else None
+
+async def _mark_turn_done(turn_id: str, user_id: str):
+    async with aiosqlite.connect(db_path_for(user_id)) as db:
+        await db.execute(
+            "UPDATE turns SET status = 'done' WHERE turn_id = ? AND user_id = ?", (turn_id, user_id)
+        )
+        await db.commit()
+
+def start_turn(turn_id: str, thread_id: str, user_id: str, run):
+    """
+    Create a journal for a turn and run `run(journal)` in the background,
+    independent of any HTTP connection. The turn must already be registered.
+    """
+    journal = TurnJournal(turn_id, thread_id, user_id)
+    _journals[(user_id, turn_id)] = journal
+
+    async def runner():
+        try:
+            await run(journal)
+        finally:
+            await journal.finish()
+            try:
+                await _mark_turn_done(turn_id, user_id)
+            except Exception as e:
+                print(f"Error recording turn {turn_id}: {e}")
+            await asyncio.sleep(JOURNAL_TTL)
+            _journals.pop((user_id, turn_id), None)
+            await journal.discard()
+
+    journal.task = asyncio.create_task(runner())
+    return journal
+
+async def stop_journals():
+    for journal in list(_journals.values()):
+        if journal.task and not journal.task.done():
+            journal.task.cancel()
+    _journals.clear()
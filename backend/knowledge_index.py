@@ -0,0 +1,68 @@
+import math
+from collections import Counter
+
+from utils import tokenize
+
+# BM25 parameters
+K1 = 1.5
+B = 0.75
+
+class KnowledgeIndex:
+    """
+    In-memory BM25 index over knowledge categories.
+    Kept up to date incrementally on every category write, so prompt-time
+    selection never has to rescan the whole user_knowledge table.
+    """
+
+    def __init__(self):
+        self.docs = {}  # category -> Counter of terms
+        self.lengths = {}  # category -> number of terms
+        self.df = Counter()  # term -> number of categories containing it
+        self.total_length = 0
+        # profile_version of the data this index reflects (see profile.py)
+        self.version = None
+
+    def upsert(self, category: str, content: str):
+        self.remove(category)
+        terms = Counter(tokenize(f"{category} {content}"))
+        self.docs[category] = terms
+        self.lengths[category] = sum(terms.values())
+        self.total_length += self.lengths[category]
+        self.df.update(terms.keys())
+
+    def remove(self, category: str):
+        terms = self.docs.pop(category, None)
+        if terms is None:
+            return
+        self.total_length -= self.lengths.pop(category)
+        self.df.subtract(terms.keys())
+        for term in terms:
+            if self.df[term] <= 0:
+                del self.df[term]
+
+    def search(self, query: str, k: int):
+        """Return up to k (category, score) pairs with a positive score, best first."""
+        if not self.docs:
+            return []
+        query_terms = set(tokenize(query))
+        n = len(self.docs)
+        avg_length = self.total_length / n or 1
+        scores = []
+        for category, terms in self.docs.items():
+            score = 0.0
+            norm = K1 * (1 - B + B * self.lengths[category] / avg_length)
+            for term in query_terms:
+                tf = terms.get(term)
+                if not tf:
+                    continue
+                idf = math.log(1 + (n - self.df[term] + 0.5) / (self.df[term] + 0.5))
+                score += idf * tf * (K1 + 1) / (tf + norm)
+            if score > 0:
+                scores.append((category, score))
+        scores.sort(key=lambda item: item[1], reverse=True)
+        return scores[:k]
+
+def estimate_tokens(text: str) -> int:
+    # Rough estimate: one token per CJK character, about four characters per token otherwise
+    cjk = sum(1 for ch in text if "一" <= ch <= "鿿")
+    return cjk + (len(text) - cjk) // 4 + 1
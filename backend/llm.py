@@ -7,10 +7,13 @@ load_dotenv()
 
 # --- Load Prompts ---
 with open(os.path.join(os.path.dirname(__file__), "prompts.yaml"), "r", encoding="utf-8") as f:
-    prompts = yaml.safe_load(f)["prompts"]
+    prompts_file = yaml.safe_load(f)
+prompts = prompts_file["prompts"]
+PROMPTS_VERSION = str(prompts_file.get("version", 0))
 
 COACH_DRAFT_PROMPT = prompts["coach_draft"]
 CRITIC_REFLECTION_PROMPT = prompts["critic_reflection"]
+CRITIC_SELECTION_PROMPT = prompts["critic_selection"]
 COACH_FINAL_PROMPT = prompts["coach_final"]
 MENTOR_PROMPT = prompts["mentor"]
 
@@ -22,3 +25,15 @@ llm = ChatOpenAI(
     temperature=0.7,
     streaming=True
 )
+
+# --- Parallel Drafts ---
+# When PARALLEL_DRAFTS > 1, generate_draft writes that many candidates concurrently
+# (one per variant below) and the critic picks the best one in a single call.
+PARALLEL_DRAFTS = int(os.getenv("PARALLEL_DRAFTS", "1"))
+
+DRAFT_VARIANTS = [
+    (0.7, ""),
+    (0.3, "请侧重严谨、准确的技术细节。"),
+    (1.0, "请侧重直观的解释、类比和示例。"),
+    (0.5, "请侧重可运行的代码示例和实践建议。"),
+]
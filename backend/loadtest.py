@@ -0,0 +1,152 @@
+"""
+Local multi-worker load test for the per-user storage shards.
+
+Starts the app under uvicorn with each requested worker count, with the LLM
+replaced by an instant canned reply (see stub_app). Many distinct users then
+post turns to POST /chat concurrently, so every request runs the whole graph
+and writes its checkpoints, metadata, search index and turn bookkeeping to the
+user's shard. The script reports turns per second, latency and the number of
+checkpoints written. With the model out of the picture this measures the
+storage path; throughput should grow with the worker count until the
+machine's cores or disk run out.
+
+    python loadtest.py --workers 1 2 4 --users 64 --duration 20
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# Turns per thread before a simulated user starts a new one, so thread
+# history (and the checkpoint size) stays realistic
+TURNS_PER_THREAD = 5
+
+def stub_app():
+    """uvicorn factory: the real app, with the LLM replaced by a canned, instant reply."""
+    os.environ.setdefault("DEEPSEEK_API_KEY", "loadtest")
+    from langchain_core.language_models.fake_chat_models import FakeListChatModel
+    import llm
+    import nodes
+    import titles
+
+    class StubModel(FakeListChatModel):
+        def bind_tools(self, tools, **kwargs):
+            # Never requests a tool, so no web search
+            return self
+
+    # Contains PASS so the critic ends the revision loop, and parses as a title
+    stub = StubModel(responses=['{"1": "PASS"}'])
+    llm.llm = nodes.llm = titles.llm = stub
+    from main import app
+    return app
+
+def request(base_url: str, method: str, path: str, user_id: str, body=None):
+    data = json.dumps(body).encode("utf-8") if body is not None else None
+    req = urllib.request.Request(f"{base_url}{path}", data=data, method=method)
+    req.add_header("X-User-Id", user_id)
+    if data is not None:
+        req.add_header("Content-Type", "application/json")
+    with urllib.request.urlopen(req, timeout=60) as response:
+        response.read()
+
+def user_loop(base_url: str, user_id: str, deadline: float):
+    """One simulated user: chat turns back to back, a new thread every few turns."""
+    latencies, errors, i = [], 0, 0
+    while time.monotonic() < deadline:
+        body = {
+            "messages": [{"role": "user", "content": f"question {i} from {user_id}"}],
+            "thread_id": f"{user_id}-{i // TURNS_PER_THREAD}"
+        }
+        start = time.monotonic()
+        try:
+            request(base_url, "POST", "/chat", user_id, body)
+            latencies.append(time.monotonic() - start)
+        except Exception:
+            errors += 1
+        i += 1
+    return latencies, errors
+
+def client_process(args):
+    base_url, user_ids, deadline = args
+    with ThreadPoolExecutor(max_workers=len(user_ids)) as pool:
+        results = list(pool.map(lambda u: user_loop(base_url, u, deadline), user_ids))
+    return [l for r in results for l in r[0]], sum(r[1] for r in results)
+
+def wait_until_up(base_url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            request(base_url, "GET", "/chat/profile", "loadtest-probe")
+            return
+        except Exception:
+            time.sleep(0.5)
+    raise RuntimeError("server did not start")
+
+def count_checkpoints(data_dir: str):
+    total = 0
+    for db_path in glob.glob(os.path.join(data_dir, "data", "shard-*.db")):
+        with sqlite3.connect(db_path) as db:
+            total += db.execute("SELECT COUNT(*) FROM checkpoints").fetchone()[0]
+    return total
+
+def run(workers: int, users: int, duration: float, port: int, clients: int):
+    base_url = f"http://127.0.0.1:{port}"
+    # The server runs in a fresh directory per run, so shards, checkpoints.db and
+    # journal.db start empty and earlier runs do not skew file sizes
+    data_dir = tempfile.mkdtemp(prefix="watson-loadtest-")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "loadtest:stub_app", "--factory",
+         "--app-dir", os.path.dirname(os.path.abspath(__file__)),
+         "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        cwd=data_dir
+    )
+    try:
+        wait_until_up(base_url)
+        user_ids = [f"loadtest-{i}" for i in range(users)]
+        deadline = time.monotonic() + duration
+        # Client load is spread over processes so the client itself is not the bottleneck
+        chunks = [(base_url, user_ids[i::clients], deadline) for i in range(clients) if user_ids[i::clients]]
+        with multiprocessing.Pool(len(chunks)) as pool:
+            results = pool.map(client_process, chunks)
+        latencies = sorted(l for r in results for l in r[0])
+        errors = sum(r[1] for r in results)
+    finally:
+        server.terminate()
+        server.wait()
+    try:
+        checkpoints = count_checkpoints(data_dir)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0
+    return len(latencies) / duration, percentile(0.5), percentile(0.95), errors, checkpoints
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--users", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--clients", type=int, default=max(1, os.cpu_count() // 2))
+    args = parser.parse_args()
+
+    baseline = None
+    print(f"{'workers':>8} {'turns/s':>10} {'speedup':>8} {'p50 ms':>8} {'p95 ms':>8} {'errors':>7} {'checkpoints':>12}")
+    for workers in args.workers:
+        throughput, p50, p95, errors, checkpoints = run(workers, args.users, args.duration, args.port, args.clients)
+        # Speedup relative to the first worker count, 1.0 per worker is linear scaling
+        baseline = baseline or throughput / workers
+        print(f"{workers:>8} {throughput:>10.1f} {throughput / baseline:>8.2f} {p50:>8.0f} {p95:>8.0f} {errors:>7} {checkpoints:>12}")
+
+if __name__ == "__main__":
+    main()
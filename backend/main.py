@@ -1,12 +1,16 @@
+import asyncio
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 from routers import chat
-from agent import cleanup_graph
+from agent import cleanup_graph, start_background_jobs
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # Resume thread purges and index existing threads for /chat/search in the background
+    background = asyncio.create_task(start_background_jobs())
     yield
+    background.cancel()
     await cleanup_graph()
 
 print("Starting main.py...", flush=True)
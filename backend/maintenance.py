@@ -0,0 +1,38 @@
+"""
+Offline maintenance for the SQLite storage files.
+
+    python maintenance.py vacuum
+
+`vacuum` converts checkpoints.db and every shard that predates incremental
+auto_vacuum, so the background purge can hand freed pages back to the file
+system. VACUUM rewrites the whole file and needs exclusive access, so stop the
+server first; on a large checkpoints.db it can take a while.
+"""
+import argparse
+import asyncio
+
+import aiosqlite
+
+from shards import existing_db_paths
+from store import auto_vacuum_mode, convert_to_incremental_vacuum
+
+async def vacuum():
+    for db_path in existing_db_paths():
+        if await auto_vacuum_mode(db_path) == 2:
+            print(f"{db_path}: already incremental")
+            continue
+        print(f"{db_path}: converting to incremental auto_vacuum...", flush=True)
+        try:
+            await convert_to_incremental_vacuum(db_path)
+        except aiosqlite.OperationalError as e:
+            print(f"Error vacuuming {db_path}: {e}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["vacuum"])
+    args = parser.parse_args()
+    if args.command == "vacuum":
+        asyncio.run(vacuum())
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,41 @@
-from langchain_core.messages import SystemMessage, AIMessage, ToolMessage
+from langchain_core.messages import SystemMessage, AIMessage, HumanMessage, ToolMessage
 from langchain_core.runnables import RunnableConfig
 from datetime import datetime
+import asyncio
+import re
 
 from state import State
-from llm import llm, COACH_DRAFT_PROMPT, CRITIC_REFLECTION_PROMPT, COACH_FINAL_PROMPT, MENTOR_PROMPT
+from llm import llm, COACH_DRAFT_PROMPT, CRITIC_REFLECTION_PROMPT, CRITIC_SELECTION_PROMPT, COACH_FINAL_PROMPT, MENTOR_PROMPT, PARALLEL_DRAFTS, DRAFT_VARIANTS
 from tools import web_search
-from profile import get_user_profile, update_knowledge_category, update_learning_goals, update_self_description
+from blobs import put_blobs
+from shards import user_id_from_config
+from profile import get_user_profile, get_relevant_profile, flush_profile_writes, update_knowledge_category, update_learning_goals, update_self_description
 
 tools = [web_search, update_knowledge_category, update_learning_goals, update_self_description]
 tool_map = {t.name: t for t in tools}
 
+# --- Profile Helpers ---
+def latest_user_message(messages) -> str:
+    for m in reversed(messages):
+        if isinstance(m, HumanMessage):
+            return str(m.content)
+    return ""
+
+def format_profile(profile) -> str:
+    knowledge_str = "\n".join([f"- {k}: {v}" for k, v in profile.get('knowledge', {}).items()]) or "None"
+    return f"User Description: {profile.get('self_description', 'None')}\n\nKnowledge Breakdown:\n{knowledge_str}\n\nLearning Goals: {profile['learning_goals']}"
+
+async def store_search_results(texts, config) -> list:
+    # Referenced by the thread, so deleting the thread can free them again
+    thread_id = config.get("configurable", {}).get("thread_id")
+    return await put_blobs(user_id_from_config(config), texts, thread_id)
+
 # --- Helper for Tool Loop ---
-async def run_with_tools(messages, config, available_tools=None):
+async def run_with_tools(messages, config, available_tools=None, model=None):
     if available_tools is None:
         available_tools = tools
         
-    bound_llm = llm.bind_tools(available_tools)
+    bound_llm = (model or llm).bind_tools(available_tools)
     
     # Loop until we get a final text response (no tool calls)
     current_messages = list(messages) # Shallow copy
@@ -33,7 +53,8 @@ async def run_with_tools(messages, config, available_tools=None):
             # For now, let's just return the response, and we handle state update in the calling node if possible.
             # But wait, run_with_tools is a helper, it doesn't return state dict.
             # We need to return both response and search results.
-            return response, "\n\n".join(all_search_results)
+            # Search payloads are stored out of line; only their hashes go into state.
+            return response, await store_search_results(all_search_results, config)
             
         # Execute tools
         current_messages.append(response)
@@ -50,7 +71,8 @@ async def run_with_tools(messages, config, available_tools=None):
                  # For web_search (sync), ainvoke runs it in threadpool.
                  # For update_learning_profile (async), ainvoke runs it directly.
                  try:
-                    tool_output = await tool_instance.ainvoke(tool_args)
+                    # config carries the user_id the profile tools write to
+                    tool_output = await tool_instance.ainvoke(tool_args, config)
                  except Exception as e:
                     tool_output = f"Error executing tool {tool_name}: {str(e)}"
                  
@@ -62,17 +84,16 @@ async def run_with_tools(messages, config, available_tools=None):
                 
             current_messages.append(ToolMessage(content=str(tool_output), tool_call_id=tool_id))
             
-    return response, "\n\n".join(all_search_results)
+    return response, await store_search_results(all_search_results, config)
 
 # --- Nodes ---
 
 async def generate_draft(state: State, config: RunnableConfig):
     messages = state["messages"]
     
-    # Get user profile
-    profile = await get_user_profile()
-    knowledge_str = "\n".join([f"- {k}: {v}" for k, v in profile.get('knowledge', {}).items()]) or "None"
-    profile_str = f"User Description: {profile.get('self_description', 'None')}\n\nKnowledge Breakdown:\n{knowledge_str}\n\nLearning Goals: {profile['learning_goals']}"
+    # Get the knowledge categories relevant to the latest question
+    profile = await get_relevant_profile(user_id_from_config(config), latest_user_message(messages))
+    profile_str = format_profile(profile)
     
     current_date = datetime.now().strftime("%Y-%m-%d")
     context_str = f"\n\nToday's Date: {current_date}\n\nCURRENT USER PROFILE:\n{profile_str}"
@@ -85,6 +106,9 @@ async def generate_draft(state: State, config: RunnableConfig):
     if revision_count > 0 and critic_feedback and "PASS" not in critic_feedback:
         # Revision mode
         sys_msg = SystemMessage(content=COACH_DRAFT_PROMPT + f"{context_str}\n\nPREVIOUS DRAFT:\n{coach_draft}\n\nCRITIC FEEDBACK:\n{critic_feedback}\n\nPlease revise the draft based on the feedback.")
+    elif PARALLEL_DRAFTS > 1:
+        # Parallel mode: several candidates at once, the critic picks the best in one pass
+        return await generate_candidates(messages, context_str, config)
     else:
         # Fresh mode
         sys_msg = SystemMessage(content=COACH_DRAFT_PROMPT + context_str)
@@ -97,15 +121,35 @@ async def generate_draft(state: State, config: RunnableConfig):
     response, search_results = await run_with_tools([sys_msg] + messages, config, available_tools=[web_search])
     return {"coach_draft": response.content, "search_results": search_results}
 
+async def generate_candidates(messages, context_str, config):
+    variants = DRAFT_VARIANTS[:PARALLEL_DRAFTS]
+
+    async def candidate(temperature, angle):
+        model = llm.model_copy(update={"temperature": temperature})
+        sys_msg = SystemMessage(content=COACH_DRAFT_PROMPT + context_str + (f"\n\n{angle}" if angle else ""))
+        # Candidates are not streamed to the user, the selected one is passed on via state
+        candidate_config = {**config, "tags": ["coach_candidate"]}
+        return await run_with_tools([sys_msg] + messages, candidate_config, available_tools=[web_search], model=model)
+
+    results = await asyncio.gather(*(candidate(t, a) for t, a in variants))
+    candidates = [response.content for response, _ in results]
+    search_results = []
+    for _, hashes in results:
+        search_results += [h for h in hashes if h not in search_results]
+    return {"coach_draft": candidates[0], "draft_candidates": candidates, "search_results": search_results}
+
 async def critique_draft(state: State, config: RunnableConfig):
     messages = state["messages"]
     draft = state.get("coach_draft", "")
     revision_count = state.get("revision_count", 0)
     
-    # Get user profile
-    profile = await get_user_profile()
-    knowledge_str = "\n".join([f"- {k}: {v}" for k, v in profile.get('knowledge', {}).items()]) or "None"
-    profile_str = f"User Description: {profile.get('self_description', 'None')}\n\nKnowledge Breakdown:\n{knowledge_str}\n\nLearning Goals: {profile['learning_goals']}"
+    # Get the knowledge categories relevant to the latest question
+    profile = await get_relevant_profile(user_id_from_config(config), latest_user_message(messages))
+    profile_str = format_profile(profile)
+
+    candidates = state.get("draft_candidates") or []
+    if len(candidates) > 1:
+        return await select_candidate(messages, candidates, profile_str, revision_count, config)
     
     # Format the prompt with the draft
     prompt = CRITIC_REFLECTION_PROMPT.format(coach_draft=draft)
@@ -123,15 +167,37 @@ async def critique_draft(state: State, config: RunnableConfig):
         # It is an internal thought process passed to generate_final via state.
     }
 
+async def select_candidate(messages, candidates, profile_str, revision_count, config):
+    numbered = "\n\n".join(f"--- 候选 {i} ---\n{c}" for i, c in enumerate(candidates, start=1))
+    prompt = CRITIC_SELECTION_PROMPT.format(candidates=numbered)
+    sys_msg = SystemMessage(content=prompt + f"\n\nCURRENT USER PROFILE:\n{profile_str}")
+
+    config["tags"] = ["critic"]
+    response = await llm.ainvoke([sys_msg] + messages, config)
+
+    # First line is "BEST: n", the rest is PASS or revision instructions for that candidate
+    match = re.search(r"BEST\s*[:：]\s*(\d+)", response.content)
+    best = int(match.group(1)) if match else 1
+    if not 1 <= best <= len(candidates):
+        best = 1
+    feedback = response.content[match.end():].strip() if match else response.content
+
+    # If every candidate failed, should_continue sends the chosen one back for a normal revision round
+    return {
+        "coach_draft": candidates[best - 1],
+        "draft_candidates": [],
+        "critic_feedback": feedback,
+        "revision_count": revision_count + 1
+    }
+
 async def generate_final(state: State, config: RunnableConfig):
     messages = state["messages"]
     feedback = state.get("critic_feedback", "")
     draft = state.get("coach_draft", "")
     
-    # Get user profile to ensure final response also considers it
-    profile = await get_user_profile()
-    knowledge_str = "\n".join([f"- {k}: {v}" for k, v in profile.get('knowledge', {}).items()]) or "None"
-    profile_str = f"User Description: {profile.get('self_description', 'None')}\n\nKnowledge Breakdown:\n{knowledge_str}\n\nLearning Goals: {profile['learning_goals']}"
+    # Get the relevant part of the user profile to ensure final response also considers it
+    profile = await get_relevant_profile(user_id_from_config(config), latest_user_message(messages))
+    profile_str = format_profile(profile)
     
     # We always want to stream the final response, even if it's just the draft.
     # So we use the LLM to output the final content.
@@ -154,10 +220,10 @@ async def generate_final(state: State, config: RunnableConfig):
 async def mentor(state: State, config: RunnableConfig):
     messages = state["messages"]
     
-    # Get user profile
-    profile = await get_user_profile()
-    knowledge_str = "\n".join([f"- {k}: {v}" for k, v in profile.get('knowledge', {}).items()]) or "None"
-    profile_str = f"User Description: {profile.get('self_description', 'None')}\n\nKnowledge Breakdown:\n{knowledge_str}\n\nLearning Goals: {profile['learning_goals']}"
+    # Mentor gets the full profile since it is responsible for updating it
+    user_id = user_id_from_config(config)
+    profile = await get_user_profile(user_id)
+    profile_str = format_profile(profile)
     
     current_date = datetime.now().strftime("%Y-%m-%d")
     sys_msg = SystemMessage(content=MENTOR_PROMPT + f"\n\nToday's Date: {current_date}\n\nCURRENT USER PROFILE:\n{profile_str}")
@@ -168,12 +234,21 @@ async def mentor(state: State, config: RunnableConfig):
     # Use run_with_tools to handle potential search for resources
     # Mentor should use both web_search and update_learning_profile
     response, search_results = await run_with_tools([sys_msg] + messages, config)
+
+    # Profile tool calls were queued; write them in one transaction at turn end
+    try:
+        await flush_profile_writes()
+    except Exception as e:
+        print(f"Error flushing profile writes: {e}")
     
     # We append new search results to existing ones if any?
     # Or maybe we just overwrite? The user probably wants to see relevant search results for the current turn.
-    # Since search_results is a string, we can append.
-    existing_search = state.get("search_results", "")
-    new_search = f"{existing_search}\n\n{search_results}" if existing_search and search_results else (search_results or existing_search)
+    # search_results holds content hashes (see blobs.py), so appending is cheap.
+    existing_search = state.get("search_results") or []
+    if isinstance(existing_search, str):
+        # Older checkpoints stored the text inline; move it out of line
+        existing_search = await store_search_results([existing_search], config)
+    new_search = existing_search + [h for h in search_results if h not in existing_search]
     
     # Clear revision state for next turn
     return {
@@ -181,5 +256,6 @@ async def mentor(state: State, config: RunnableConfig):
         "search_results": new_search,
         "revision_count": 0,
         "critic_feedback": "",
-        "coach_draft": ""
+        "coach_draft": "",
+        "draft_candidates": []
     }
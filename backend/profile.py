@@ -1,120 +1,307 @@
+import asyncio
 import aiosqlite
 import json
+from collections import defaultdict
+from contextlib import AsyncExitStack
 from langchain_core.tools import tool
+from langchain_core.runnables import RunnableConfig
 
-DB_PATH = "checkpoints.db"
+from knowledge_index import KnowledgeIndex, estimate_tokens
+from shards import DEFAULT_USER_ID, db_path_for, user_id_from_config
 
-async def ensure_profile_table():
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Table for general profile info (goals)
+# Prompt-time knowledge selection (see get_relevant_profile)
+RELEVANT_CATEGORIES_K = 5
+KNOWLEDGE_TOKEN_BUDGET = 800
+
+PROFILE_COLUMNS = ("learning_goals", "self_description")
+PROFILE_FLUSH_DELAY = 2.0
+
+_pending_writes = {}  # (user_id, "knowledge", category) | (user_id, "profile", column) -> latest value
+_flush_lock = asyncio.Lock()
+_flush_timer = None
+# Orders direct edits against flushes of the same user, so a queued mentor value
+# can never be committed after (and overwrite) a newer direct edit
+_user_locks = defaultdict(asyncio.Lock)
+
+_knowledge_indexes = {}  # user_id -> KnowledgeIndex
+
+async def ensure_profile_table(db_path: str):
+    async with aiosqlite.connect(db_path) as db:
+        # Table for general profile info (goals), one row per user
         await db.execute("""
             CREATE TABLE IF NOT EXISTS user_profile (
                 id TEXT PRIMARY KEY,
                 learning_goals TEXT,
                 self_description TEXT,
+                profile_version INTEGER DEFAULT 0,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
+        # Migration: older databases were created before self_description existed.
+        # Done once here so the read/write paths never probe the schema.
+        try:
+            await db.execute("SELECT self_description FROM user_profile LIMIT 1")
+        except aiosqlite.OperationalError:
+            await db.execute("ALTER TABLE user_profile ADD COLUMN self_description TEXT")
+        # Migration: bumped on every profile write, so each process can tell
+        # whether its cached knowledge index is still current
+        try:
+            await db.execute("SELECT profile_version FROM user_profile LIMIT 1")
+        except aiosqlite.OperationalError:
+            await db.execute("ALTER TABLE user_profile ADD COLUMN profile_version INTEGER DEFAULT 0")
+
+        # Migration: user_knowledge used to be keyed on category alone
+        async with db.execute("PRAGMA table_info(user_knowledge)") as cursor:
+            columns = [row[1] for row in await cursor.fetchall()]
+        if columns and "user_id" not in columns:
+            await db.execute("ALTER TABLE user_knowledge RENAME TO user_knowledge_legacy")
         # Table for categorized knowledge
         await db.execute("""
             CREATE TABLE IF NOT EXISTS user_knowledge (
-                category TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                category TEXT NOT NULL,
                 content TEXT,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, category)
             )
         """)
+        if columns and "user_id" not in columns:
+            await db.execute("""
+                INSERT INTO user_knowledge (user_id, category, content, updated_at)
+                SELECT ?, category, content, updated_at FROM user_knowledge_legacy
+            """, (DEFAULT_USER_ID,))
+            await db.execute("DROP TABLE user_knowledge_legacy")
         await db.commit()
 
-async def get_user_profile():
-    async with aiosqlite.connect(DB_PATH) as db:
+async def _read_profile_row(db, user_id: str):
+    goals = "尚无学习目标。"
+    description = "尚无自我描述。"
+    version = 0
+    async with db.execute("SELECT learning_goals, self_description, profile_version FROM user_profile WHERE id = ?", (user_id,)) as cursor:
+        row = await cursor.fetchone()
+        if row:
+            goals = row[0] or goals
+            description = row[1] or description
+            version = row[2] or 0
+    return goals, description, version
+
+async def get_user_profile(user_id: str = DEFAULT_USER_ID):
+    async with aiosqlite.connect(db_path_for(user_id)) as db:
         # Get goals and description
-        goals = "尚无学习目标。"
-        description = "尚无自我描述。"
-        
-        # Check if column exists (for migration)
-        try:
-            async with db.execute("SELECT learning_goals, self_description FROM user_profile WHERE id = 'global'") as cursor:
-                row = await cursor.fetchone()
-                if row:
-                    goals = row[0] or goals
-                    description = row[1] or description
-        except aiosqlite.OperationalError:
-            # Fallback if column missing, or run migration
-            # For simplicity, we just fetch goals if description column missing
-             async with db.execute("SELECT learning_goals FROM user_profile WHERE id = 'global'") as cursor:
-                row = await cursor.fetchone()
-                if row:
-                    goals = row[0] or goals
-        
+        goals, description, _ = await _read_profile_row(db, user_id)
+
         # Get knowledge categories
         knowledge = {}
-        async with db.execute("SELECT category, content FROM user_knowledge") as cursor:
+        async with db.execute("SELECT category, content FROM user_knowledge WHERE user_id = ?", (user_id,)) as cursor:
             rows = await cursor.fetchall()
             for r in rows:
                 knowledge[r[0]] = r[1]
-        
+
         return {
             "learning_goals": goals,
             "self_description": description,
             "knowledge": knowledge
         }
 
-async def clear_user_profile():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM user_profile WHERE id = 'global'")
-        await db.execute("DELETE FROM user_knowledge")
-        await db.commit()
+async def get_relevant_profile(user_id: str, query: str, k: int = RELEVANT_CATEGORIES_K, token_budget: int = KNOWLEDGE_TOKEN_BUDGET):
+    """
+    Like get_user_profile, but only returns the knowledge categories most relevant
+    to `query` (BM25 over the local knowledge index), capped by a token budget.
+    Queries that match nothing ("继续", "what next?") get the most recently
+    updated categories instead.
+    """
+    async with aiosqlite.connect(db_path_for(user_id)) as db:
+        goals, description, version = await _read_profile_row(db, user_id)
+
+        # Built from the database on first use (or after another process changed the
+        # profile), then maintained incrementally by profile writes in this process
+        index = _knowledge_indexes.get(user_id)
+        if index is None or index.version != version:
+            async with db.execute("SELECT category, content FROM user_knowledge WHERE user_id = ?", (user_id,)) as cursor:
+                rows = await cursor.fetchall()
+            index = KnowledgeIndex()
+            for category, content in rows:
+                index.upsert(category, content or "")
+            index.version = version
+            _knowledge_indexes[user_id] = index
+        ranked = [category for category, _ in index.search(query, k)]
+
+        rows = {}
+        if ranked:
+            placeholders = ",".join("?" * len(ranked))
+            async with db.execute(
+                f"SELECT category, content FROM user_knowledge WHERE user_id = ? AND category IN ({placeholders})",
+                [user_id, *ranked]
+            ) as cursor:
+                rows = dict(await cursor.fetchall())
+        else:
+            async with db.execute(
+                "SELECT category, content FROM user_knowledge WHERE user_id = ? ORDER BY updated_at DESC LIMIT ?",
+                (user_id, k)
+            ) as cursor:
+                recent = await cursor.fetchall()
+            ranked = [category for category, _ in recent]
+            rows = dict(recent)
+
+    knowledge = {}
+    used = 0
+    for category in ranked:
+        if category not in rows:
+            continue
+        cost = estimate_tokens(f"{category}: {rows[category]}")
+        if used + cost > token_budget and knowledge:
+            break
+        knowledge[category] = rows[category]
+        used += cost
+
+    return {
+        "learning_goals": goals,
+        "self_description": description,
+        "knowledge": knowledge
+    }
+
+async def clear_user_profile(user_id: str = DEFAULT_USER_ID):
+    async with _user_locks[user_id]:
+        for key in [key for key in _pending_writes if key[0] == user_id]:
+            del _pending_writes[key]
+        await _clear_profile_rows(user_id)
+    _knowledge_indexes.pop(user_id, None)
     return {"message": "User profile cleared successfully"}
 
-async def set_knowledge_category(category: str, content: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+async def _clear_profile_rows(user_id: str):
+    async with aiosqlite.connect(db_path_for(user_id)) as db:
+        # Keep the row so profile_version keeps increasing
         await db.execute("""
-            INSERT INTO user_knowledge (category, content, updated_at)
-            VALUES (?, ?, CURRENT_TIMESTAMP)
-            ON CONFLICT(category) DO UPDATE SET
-                content = excluded.content,
-                updated_at = CURRENT_TIMESTAMP
-        """, (category, content))
+            UPDATE user_profile
+            SET learning_goals = NULL, self_description = NULL, profile_version = profile_version + 1
+            WHERE id = ?
+        """, (user_id,))
+        await db.execute("DELETE FROM user_knowledge WHERE user_id = ?", (user_id,))
         await db.commit()
 
-async def set_learning_goals(goals: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Check if column exists, if not add it
-        try:
-            await db.execute("SELECT self_description FROM user_profile LIMIT 1")
-        except aiosqlite.OperationalError:
-            await db.execute("ALTER TABLE user_profile ADD COLUMN self_description TEXT")
-            await db.commit()
+async def _apply_profile_writes(db, user_id: str, writes):
+    """
+    Apply {("knowledge", category) | ("profile", column): value} for one user on an
+    open connection. Returns the new profile_version.
+    """
+    knowledge = [(user_id, key[1], value) for key, value in writes.items() if key[0] == "knowledge"]
+    columns = {key[1]: value for key, value in writes.items() if key[0] == "profile" and key[1] in PROFILE_COLUMNS}
 
-        await db.execute("""
-            INSERT INTO user_profile (id, learning_goals, updated_at)
-            VALUES ('global', ?, CURRENT_TIMESTAMP)
-            ON CONFLICT(id) DO UPDATE SET
-                learning_goals = excluded.learning_goals,
+    if knowledge:
+        await db.executemany("""
+            INSERT INTO user_knowledge (user_id, category, content, updated_at)
+            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(user_id, category) DO UPDATE SET
+                content = excluded.content,
                 updated_at = CURRENT_TIMESTAMP
-        """, (goals,))
+        """, knowledge)
+
+    names = list(columns)
+    await db.execute(f"""
+        INSERT INTO user_profile (id, {"".join(f"{name}, " for name in names)}profile_version, updated_at)
+        VALUES (?, {"".join("?, " for _ in names)}1, CURRENT_TIMESTAMP)
+        ON CONFLICT(id) DO UPDATE SET
+            {"".join(f"{name} = excluded.{name}, " for name in names)}
+            profile_version = profile_version + 1,
+            updated_at = CURRENT_TIMESTAMP
+    """, [user_id, *[columns[name] for name in names]])
+    async with db.execute("SELECT profile_version FROM user_profile WHERE id = ?", (user_id,)) as cursor:
+        return (await cursor.fetchone())[0]
+
+def _update_knowledge_index(user_id: str, writes, version: int):
+    index = _knowledge_indexes.get(user_id)
+    if index is None:
+        return
+    if index.version != version - 1:
+        # Another process wrote in between, rebuild on next read
+        del _knowledge_indexes[user_id]
+        return
+    for key, value in writes.items():
+        if key[0] == "knowledge":
+            index.upsert(key[1], value)
+    index.version = version
+
+async def write_profile(user_id: str, writes):
+    async with aiosqlite.connect(db_path_for(user_id)) as db:
+        version = await _apply_profile_writes(db, user_id, writes)
         await db.commit()
+    _update_knowledge_index(user_id, writes, version)
 
-async def set_self_description(description: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Check if column exists, if not add it
-        try:
-            await db.execute("SELECT self_description FROM user_profile LIMIT 1")
-        except aiosqlite.OperationalError:
-            await db.execute("ALTER TABLE user_profile ADD COLUMN self_description TEXT")
+async def _direct_write(user_id: str, kind: str, key: str, value: str):
+    async with _user_locks[user_id]:
+        # A direct edit supersedes any queued mentor update for the same key
+        _pending_writes.pop((user_id, kind, key), None)
+        await write_profile(user_id, {(kind, key): value})
+
+async def set_knowledge_category(category: str, content: str, user_id: str = DEFAULT_USER_ID):
+    await _direct_write(user_id, "knowledge", category, content)
+
+async def set_learning_goals(goals: str, user_id: str = DEFAULT_USER_ID):
+    await _direct_write(user_id, "profile", "learning_goals", goals)
+
+async def set_self_description(description: str, user_id: str = DEFAULT_USER_ID):
+    await _direct_write(user_id, "profile", "self_description", description)
+
+# --- Write-behind queue for mentor updates ---
+# Mentor tool calls are merged here (last writer wins per key) and written in a
+# single transaction per shard at the end of the turn, or after PROFILE_FLUSH_DELAY seconds.
+
+def queue_profile_write(user_id: str, kind: str, key: str, value: str):
+    global _flush_timer
+    _pending_writes[(user_id, kind, key)] = value
+    if _flush_timer is None or _flush_timer.done():
+        _flush_timer = asyncio.create_task(_delayed_flush())
+
+async def _delayed_flush():
+    await asyncio.sleep(PROFILE_FLUSH_DELAY)
+    try:
+        await flush_profile_writes()
+    except Exception as e:
+        print(f"Error flushing profile writes: {e}")
+
+async def flush_profile_writes():
+    async with _flush_lock:
+        if not _pending_writes:
+            return
+        # db_path -> users with queued writes
+        shards = defaultdict(set)
+        for user_id, _, _ in _pending_writes:
+            shards[db_path_for(user_id)].add(user_id)
+
+        failed = None
+        for db_path, shard_users in shards.items():
+            async with AsyncExitStack() as stack:
+                for user_id in sorted(shard_users):
+                    await stack.enter_async_context(_user_locks[user_id])
+                # Taken under the user locks: a direct edit has either already
+                # removed its key from the queue or waits for this transaction
+                users = defaultdict(dict)  # user_id -> {(kind, key): value}
+                for queued in [q for q in _pending_writes if q[0] in shard_users]:
+                    users[queued[0]][(queued[1], queued[2])] = _pending_writes.pop(queued)
+                failed = await _flush_shard(db_path, users) or failed
+        if failed:
+            raise failed
+
+async def _flush_shard(db_path: str, users):
+    """Write {user_id: {(kind, key): value}} in one transaction. Returns the error, if any."""
+    try:
+        versions = {}
+        async with aiosqlite.connect(db_path) as db:
+            for user_id, user_writes in users.items():
+                versions[user_id] = await _apply_profile_writes(db, user_id, user_writes)
             await db.commit()
-            
-        await db.execute("""
-            INSERT INTO user_profile (id, self_description, updated_at)
-            VALUES ('global', ?, CURRENT_TIMESTAMP)
-            ON CONFLICT(id) DO UPDATE SET
-                self_description = excluded.self_description,
-                updated_at = CURRENT_TIMESTAMP
-        """, (description,))
-        await db.commit()
+        for user_id, user_writes in users.items():
+            _update_knowledge_index(user_id, user_writes, versions[user_id])
+        return None
+    except Exception as e:
+        # Put the batch back unless a newer value was queued meanwhile
+        for user_id, user_writes in users.items():
+            for (kind, key), value in user_writes.items():
+                _pending_writes.setdefault((user_id, kind, key), value)
+        return e
 
 @tool
-async def update_knowledge_category(category: str, content: str) -> str:
+async def update_knowledge_category(category: str, content: str, config: RunnableConfig) -> str:
     """
     Update the user's knowledge summary for a specific category.
     This allows for granular updates without overwriting other knowledge areas.
@@ -124,13 +311,13 @@ async def update_knowledge_category(category: str, content: str) -> str:
         content: A summary of what the user knows and what they are missing in this category.
     """
     try:
-        await set_knowledge_category(category, content)
+        queue_profile_write(user_id_from_config(config), "knowledge", category, content)
         return f"Successfully updated knowledge category: {category}"
     except Exception as e:
         return f"Error updating knowledge category: {str(e)}"
 
 @tool
-async def update_learning_goals(goals: str) -> str:
+async def update_learning_goals(goals: str, config: RunnableConfig) -> str:
     """
     Update the user's current learning goals.
     
@@ -138,13 +325,13 @@ async def update_learning_goals(goals: str) -> str:
         goals: A text description of the user's short-term and long-term learning objectives.
     """
     try:
-        await set_learning_goals(goals)
+        queue_profile_write(user_id_from_config(config), "profile", "learning_goals", goals)
         return "Successfully updated learning goals."
     except Exception as e:
         return f"Error updating learning goals: {str(e)}"
 
 @tool
-async def update_self_description(description: str) -> str:
+async def update_self_description(description: str, config: RunnableConfig) -> str:
     """
     Update the user's self-description.
     This includes their background, learning style, preferences, personality traits, and any other relevant context.
@@ -153,7 +340,7 @@ async def update_self_description(description: str) -> str:
         description: A text description of the user.
     """
     try:
-        await set_self_description(description)
+        queue_profile_write(user_id_from_config(config), "profile", "self_description", description)
         return "Successfully updated self description."
     except Exception as e:
         return f"Error updating self description: {str(e)}"
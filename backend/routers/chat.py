@@ -1,50 +1,82 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query, Header, Depends
 from fastapi.responses import StreamingResponse
+import asyncio
 import json
 import uuid
-from agent import get_graph, get_all_threads, summarize_thread, delete_thread, delete_all_threads
+from typing import Optional
+from langchain_core.messages import HumanMessage, AIMessage
+from agent import get_graph, get_all_threads, finish_turn, delete_thread, delete_all_threads
+from deletion import get_deletion_progress
+from store import search_messages, claim_thread, thread_belongs_to
+from shards import DEFAULT_USER_ID, valid_user_id
+from journal import start_turn, get_journal, register_turn, get_turn_status
+from answer_cache import answer_cache, answer_cache_key
+from blobs import resolve_search_results
 from profile import get_user_profile, clear_user_profile, set_learning_goals, set_knowledge_category, set_self_description
-from schemas import ChatRequest, ChatResponse, UpdateGoalsRequest, UpdateKnowledgeRequest, UpdateDescriptionRequest
+from schemas import ChatRequest, ChatResponse, BatchChatRequest, BatchChatResult, BatchChatResponse, UpdateGoalsRequest, UpdateKnowledgeRequest, UpdateDescriptionRequest
 from utils import map_to_langchain_messages, map_from_langchain_messages
 
 router = APIRouter()
 
+def check_user_id(user_id: str) -> str:
+    if not valid_user_id(user_id):
+        raise HTTPException(status_code=400, detail="Invalid user id")
+    return user_id
+
+async def get_user_id(x_user_id: Optional[str] = Header(None)) -> str:
+    # Requests without a user id act on the default (single-user) profile and threads
+    user_id = check_user_id(x_user_id or DEFAULT_USER_ID)
+    # Opening the user's graph also creates their shard file and tables
+    await get_graph(user_id)
+    return user_id
+
+async def claim_or_403(user_id: str, thread_id: str):
+    if not await claim_thread(user_id, thread_id):
+        raise HTTPException(status_code=403, detail="Thread belongs to another user or is being deleted")
+
 @router.put("/profile/description")
-async def update_description(request: UpdateDescriptionRequest):
+async def update_description(request: UpdateDescriptionRequest, user_id: str = Depends(get_user_id)):
     try:
-        await set_self_description(request.description)
+        await set_self_description(request.description, user_id=user_id)
         return {"message": "Self description updated successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.put("/profile/goals")
-async def update_goals(request: UpdateGoalsRequest):
+async def update_goals(request: UpdateGoalsRequest, user_id: str = Depends(get_user_id)):
     try:
-        await set_learning_goals(request.goals)
+        await set_learning_goals(request.goals, user_id=user_id)
         return {"message": "Learning goals updated successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.put("/profile/knowledge")
-async def update_knowledge(request: UpdateKnowledgeRequest):
+async def update_knowledge(request: UpdateKnowledgeRequest, user_id: str = Depends(get_user_id)):
     try:
-        await set_knowledge_category(request.category, request.content)
+        await set_knowledge_category(request.category, request.content, user_id=user_id)
         return {"message": "Knowledge category updated successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.delete("/threads")
-async def remove_all_threads():
+async def remove_all_threads(user_id: str = Depends(get_user_id)):
     try:
-        await delete_all_threads()
+        # Threads disappear from listings now; rows are purged in the background
+        await delete_all_threads(user_id)
         return {"message": "All threads deleted successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/threads/deletion")
+async def deletion_status(user_id: str = Depends(get_user_id)):
+    return await get_deletion_progress(user_id)
+
 @router.delete("/threads/{thread_id}")
-async def remove_thread(thread_id: str):
+async def remove_thread(thread_id: str, user_id: str = Depends(get_user_id)):
+    if not await thread_belongs_to(user_id, thread_id):
+        raise HTTPException(status_code=404, detail="Thread not found")
     try:
-        success = await delete_thread(thread_id)
+        success = await delete_thread(user_id, thread_id)
         if not success:
              raise HTTPException(status_code=404, detail="Thread not found")
         return {"message": "Thread deleted successfully"}
@@ -52,33 +84,43 @@ async def remove_thread(thread_id: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.delete("/profile")
-async def delete_profile():
+async def delete_profile(user_id: str = Depends(get_user_id)):
     try:
-        result = await clear_user_profile()
+        result = await clear_user_profile(user_id)
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/profile")
-async def get_profile():
+async def get_profile(user_id: str = Depends(get_user_id)):
     try:
-        profile = await get_user_profile()
+        profile = await get_user_profile(user_id)
         return profile
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/threads")
-async def get_threads():
+async def get_threads(user_id: str = Depends(get_user_id)):
     try:
-        threads = await get_all_threads()
+        threads = await get_all_threads(user_id)
         return {"threads": threads}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/search")
+async def search(q: str = Query(..., min_length=1), limit: int = Query(20, ge=1, le=100), user_id: str = Depends(get_user_id)):
+    try:
+        results = await search_messages(user_id, q, limit)
+        return {"results": results}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.get("/history/{thread_id}")
-async def get_chat_history(thread_id: str):
+async def get_chat_history(thread_id: str, user_id: str = Depends(get_user_id)):
+    if not await thread_belongs_to(user_id, thread_id):
+        return {"messages": []}
     try:
-        graph = await get_graph()
+        graph = await get_graph(user_id)
         state = await graph.aget_state({"configurable": {"thread_id": thread_id}})
         
         if not state.values:
@@ -90,17 +132,59 @@ async def get_chat_history(thread_id: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+async def stream_journal(journal, last_event_id: int = 0):
+    # Every SSE event carries its journal sequence number so clients can resume
+    async for seq, data in journal.replay(last_event_id):
+        yield f"id: {seq}\ndata: {data}\n\n"
+
+def parse_last_event_id(last_event_id: Optional[str]) -> int:
+    try:
+        return int(last_event_id or 0)
+    except ValueError:
+        return 0
+
+def raise_unresumable(status: Optional[str]):
+    # Known turns whose journal is not in this process are never run again
+    if status == "running":
+        raise HTTPException(status_code=409, detail="Turn is still running in another worker")
+    if status == "done":
+        raise HTTPException(status_code=410, detail="Turn already finished and can no longer be resumed")
+    raise HTTPException(status_code=404, detail="Turn not found or expired")
+
+@router.get("/stream/{turn_id}")
+async def resume_chat_stream(turn_id: str, last_event_id: Optional[str] = Header(None), user_id: str = Depends(get_user_id)):
+    journal = get_journal(turn_id, user_id)
+    if not journal:
+        raise_unresumable(await get_turn_status(turn_id, user_id))
+    return StreamingResponse(stream_journal(journal, parse_last_event_id(last_event_id)), media_type="text/event-stream")
+
 @router.post("/stream")
-async def chat_stream(request: ChatRequest):
+async def chat_stream(request: ChatRequest, last_event_id: Optional[str] = Header(None), header_user_id: str = Depends(get_user_id)):
+    user_id = check_user_id(request.user_id or header_user_id)
+    # Initialize graph lazily (one per storage shard)
+    graph = await get_graph(user_id)
+    # Configure thread_id
+    thread_id = request.thread_id or str(uuid.uuid4())
+    await claim_or_403(user_id, thread_id)
     try:
+        # A retry of a turn that is still journaled resumes it instead of running the graph again
+        journal = get_journal(request.turn_id, user_id) if request.turn_id else None
+        if journal and journal.thread_id == thread_id:
+            return StreamingResponse(stream_journal(journal, parse_last_event_id(last_event_id)), media_type="text/event-stream")
+
         input_messages = map_to_langchain_messages(request.messages)
         
-        # Configure thread_id
-        thread_id = request.thread_id or str(uuid.uuid4())
-        config = {"configurable": {"thread_id": thread_id}}
-        
-        # Initialize graph lazily
-        graph = await get_graph()
+        turn_id = request.turn_id or str(uuid.uuid4())
+        # user_id routes profile reads/writes inside the nodes and tools
+        config = {"configurable": {"thread_id": thread_id, "user_id": user_id}}
+
+        # Only first turns are cached: the answer must not depend on earlier context
+        cache_key = None
+        if request.use_cache and len(input_messages) == 1 and isinstance(input_messages[0], HumanMessage):
+            state = await graph.aget_state(config)
+            if not (state.values or {}).get("messages"):
+                cache_key = await answer_cache_key(user_id, str(input_messages[0].content))
+        cached_answer = answer_cache.get(cache_key) if cache_key else None
 
         async def event_generator():
             async for event in graph.astream_events({"messages": input_messages}, config=config, version="v1"):
@@ -111,10 +195,17 @@ async def chat_stream(request: ChatRequest):
                 if kind == "on_chain_start":
                     # LangGraph nodes often appear as on_chain_start with the node name
                     if name == "generate_draft":
-                        yield f"data: {json.dumps({'type': 'revision_start', 'node': 'coach_draft'})}\n\n"
+                        yield json.dumps({'type': 'revision_start', 'node': 'coach_draft'})
                     elif name == "critique_draft":
-                        yield f"data: {json.dumps({'type': 'revision_start', 'node': 'critic'})}\n\n"
+                        yield json.dumps({'type': 'revision_start', 'node': 'critic'})
                 
+                if kind == "on_chain_end" and name == "critique_draft":
+                    # Parallel candidates are not streamed (see below), so send the
+                    # draft the critic selected once it is known
+                    output = event["data"].get("output")
+                    if isinstance(output, dict) and "draft_candidates" in output and output.get("coach_draft"):
+                        yield json.dumps({'content': output['coach_draft'], 'node': 'coach_draft'})
+
                 if kind == "on_tool_end":
                     # We want to capture the tool output for "web_search"
                     # name is the tool name (e.g., "web_search")
@@ -136,7 +227,7 @@ async def chat_stream(request: ChatRequest):
                              # output is likely the return string of the tool
                              # We want to stream this to the frontend as "search_results"
                              # We can use a special node name for this, e.g., "search"
-                             yield f"data: {json.dumps({'content': str(output), 'node': 'search'})}\n\n"
+                             yield json.dumps({'content': str(output), 'node': 'search'})
 
                 if kind == "on_chat_model_stream":
                     # Check metadata for node name
@@ -146,6 +237,10 @@ async def chat_stream(request: ChatRequest):
                     
                     tags = event.get("tags", [])
                     node_name = ""
+
+                    # Parallel draft candidates are not streamed, the critic picks one of them
+                    if "coach_candidate" in tags:
+                        continue
                     
                     if "coach_draft" in tags:
                         node_name = "coach_draft"
@@ -171,29 +266,117 @@ async def chat_stream(request: ChatRequest):
                     if node_name:
                         content = event["data"]["chunk"].content
                         if content:
-                            yield f"data: {json.dumps({'content': content, 'node': node_name})}\n\n"
-                            
-            yield "data: [DONE]\n\n"
+                            yield json.dumps({'content': content, 'node': node_name})
+
+        # The turn runs in the background and writes to its journal, so a dropped
+        # connection neither cancels it nor requires re-running the pipeline
+        async def run_turn(journal):
+            await journal.append(json.dumps({'type': 'turn_start', 'turn_id': turn_id, 'thread_id': thread_id}))
+            if cached_answer is not None:
+                await run_cached_turn(journal)
+                return
+            try:
+                async for payload in event_generator():
+                    await journal.append(payload)
+                if cache_key:
+                    await store_answer()
+            except Exception as e:
+                await journal.append(json.dumps({'type': 'error', 'content': str(e)}))
+            await journal.append("[DONE]")
+            await journal.finish()
             
-            # Generate title for the thread
-            await summarize_thread(thread_id)
+            # Generate title and update the search index for the thread
+            await finish_turn(user_id, thread_id)
+
+        async def run_cached_turn(journal):
+            await journal.append(json.dumps({'content': cached_answer, 'node': 'coach'}))
+            await journal.append("[DONE]")
+            await journal.finish()
 
-        return StreamingResponse(event_generator(), media_type="text/event-stream")
+            # Record the turn as if generate_final produced it, then let the graph
+            # continue with the mentor so profile learning still happens
+            try:
+                await graph.aupdate_state(
+                    config,
+                    {"messages": input_messages + [AIMessage(content=cached_answer, name="coach")]},
+                    as_node="generate_final"
+                )
+                await graph.ainvoke(None, config)
+                await finish_turn(user_id, thread_id)
+            except Exception as e:
+                print(f"Error recording cached turn for {thread_id}: {e}")
+
+        async def store_answer():
+            state = await graph.aget_state(config)
+            messages = (state.values or {}).get("messages", [])
+            if messages and isinstance(messages[-1], AIMessage) and messages[-1].content:
+                answer_cache.put(cache_key, str(messages[-1].content))
+
+        # A retry that reached a process without the journal (or after JOURNAL_TTL)
+        # must not run the pipeline a second time
+        status = await register_turn(turn_id, thread_id, user_id)
+        if status:
+            raise_unresumable(status)
+        journal = start_turn(turn_id, thread_id, user_id, run_turn)
+        return StreamingResponse(stream_journal(journal), media_type="text/event-stream")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+async def run_chat_turn(request: ChatRequest, user_id: str) -> ChatResponse:
+    input_messages = map_to_langchain_messages(request.messages)
+    graph = await get_graph(user_id)
+    
+    # Configure thread_id
+    thread_id = request.thread_id or str(uuid.uuid4())
+    await claim_or_403(user_id, thread_id)
+    config = {"configurable": {"thread_id": thread_id, "user_id": user_id}}
+
+    # Node updates only carry what each node produced, so the response does not
+    # grow with the thread history. critic_feedback is captured here because the
+    # mentor clears it from the final state.
+    new_messages = []
+    details = {}
+    async for update in graph.astream({"messages": input_messages}, config=config, stream_mode="updates"):
+        for node, values in update.items():
+            if not values:
+                continue
+            new_messages.extend(values.get("messages", []))
+            for key in ("critic_feedback", "mentor_advice", "search_results"):
+                if values.get(key):
+                    details[key] = values[key]
+    await finish_turn(user_id, thread_id)
+
+    response = ChatResponse(messages=map_from_langchain_messages(new_messages), thread_id=thread_id)
+    if request.include_details:
+        response.critic_feedback = details.get("critic_feedback")
+        response.mentor_advice = details.get("mentor_advice")
+        response.search_results = await resolve_search_results(user_id, details.get("search_results", []))
+    return response
+
 @router.post("", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, user_id: str = Depends(get_user_id)):
     try:
-        input_messages = map_to_langchain_messages(request.messages)
-        graph = await get_graph()
-        
-        # Configure thread_id
-        thread_id = request.thread_id or str(uuid.uuid4())
-        config = {"configurable": {"thread_id": thread_id}}
-        
-        final_state = await graph.ainvoke({"messages": input_messages}, config=config)
-        output_messages = map_from_langchain_messages(final_state["messages"])
-        return ChatResponse(messages=output_messages)
+        return await run_chat_turn(request, check_user_id(request.user_id or user_id))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/batch", response_model=BatchChatResponse)
+async def chat_batch(request: BatchChatRequest, user_id: str = Depends(get_user_id)):
+    # Independent prompts (each on its own thread) run concurrently, bounded by max_concurrency
+    semaphore = asyncio.Semaphore(request.max_concurrency)
+
+    async def run_one(item: ChatRequest):
+        async with semaphore:
+            try:
+                return BatchChatResult(response=await run_chat_turn(item, check_user_id(item.user_id or user_id)))
+            except HTTPException as e:
+                return BatchChatResult(error=str(e.detail))
+            except Exception as e:
+                return BatchChatResult(error=str(e))
+
+    results = await asyncio.gather(*(run_one(item) for item in request.requests))
+    return BatchChatResponse(results=results)
@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, field_validator
 from typing import List, Optional
 
 class Message(BaseModel):
@@ -8,9 +8,37 @@ class Message(BaseModel):
 class ChatRequest(BaseModel):
     messages: List[Message]
     thread_id: Optional[str] = None
+    turn_id: Optional[str] = None  # Client-chosen id, lets a retry resume instead of re-running
+    use_cache: bool = True  # Set to False to bypass the first-turn answer cache
+    include_details: bool = False  # POST /chat: also return critic/mentor/search output
+    user_id: Optional[str] = None  # Overrides the X-User-Id header; profiles and threads are per user
 
 class ChatResponse(BaseModel):
-    messages: List[Message]
+    messages: List[Message]  # Only the messages produced in this turn
+    thread_id: Optional[str] = None
+    critic_feedback: Optional[str] = None
+    mentor_advice: Optional[str] = None
+    search_results: Optional[str] = None
+
+class BatchChatRequest(BaseModel):
+    requests: List[ChatRequest] = Field(..., max_length=32)
+    max_concurrency: int = Field(4, ge=1, le=16)
+
+    @field_validator("requests")
+    @classmethod
+    def distinct_threads(cls, requests):
+        # Items run concurrently, two of them on one thread would interleave its checkpoints
+        thread_ids = [r.thread_id for r in requests if r.thread_id]
+        if len(thread_ids) != len(set(thread_ids)):
+            raise ValueError("each thread_id may appear only once per batch")
+        return requests
+
+class BatchChatResult(BaseModel):
+    response: Optional[ChatResponse] = None
+    error: Optional[str] = None
+
+class BatchChatResponse(BaseModel):
+    results: List[BatchChatResult]
 
 class UpdateGoalsRequest(BaseModel):
     goals: str
@@ -0,0 +1,35 @@
+import glob
+import hashlib
+import os
+import re
+
+# Storage is partitioned per user. Each user is routed to one SQLite file, so
+# worker processes serving disjoint users never contend for the same write lock.
+# The default user keeps using the original checkpoints.db, so existing
+# single-user installs see all of their data unchanged.
+DEFAULT_USER_ID = "global"
+LEGACY_DB_PATH = "checkpoints.db"
+SHARD_DIR = os.getenv("WATSON_SHARD_DIR", "data")
+SHARD_COUNT = int(os.getenv("WATSON_SHARD_COUNT", "16"))
+
+_USER_ID_RE = re.compile(r"^[A-Za-z0-9_.@-]{1,64}$")
+
+def valid_user_id(user_id: str) -> bool:
+    return bool(_USER_ID_RE.match(user_id or ""))
+
+def db_path_for(user_id: str) -> str:
+    if not user_id or user_id == DEFAULT_USER_ID:
+        return LEGACY_DB_PATH
+    shard = int(hashlib.sha256(user_id.encode("utf-8")).hexdigest()[:8], 16) % SHARD_COUNT
+    return os.path.join(SHARD_DIR, f"shard-{shard:02d}.db")
+
+def existing_db_paths():
+    """Every shard file that has been created so far, for maintenance jobs."""
+    paths = sorted(glob.glob(os.path.join(SHARD_DIR, "shard-*.db")))
+    if os.path.exists(LEGACY_DB_PATH):
+        paths.insert(0, LEGACY_DB_PATH)
+    return paths
+
+def user_id_from_config(config) -> str:
+    """user_id of the current graph run, as passed in config["configurable"]."""
+    return (config or {}).get("configurable", {}).get("user_id") or DEFAULT_USER_ID
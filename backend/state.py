@@ -4,7 +4,8 @@ from langgraph.graph.message import add_messages
 class State(TypedDict):
     messages: Annotated[list, add_messages]
     coach_draft: str
+    draft_candidates: list  # Parallel drafts waiting for critic selection
     critic_feedback: str
     mentor_advice: str
-    search_results: str  # New field to store search results for frontend
+    search_results: list  # Content hashes of search results, resolved lazily via blobs.py
     revision_count: int
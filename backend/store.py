@@ -1,8 +1,20 @@
 import aiosqlite
+import re
 import sqlite3
 
-async def ensure_metadata_table():
-    async with aiosqlite.connect("checkpoints.db") as db:
+from shards import DEFAULT_USER_ID, db_path_for
+
+# Rows of threads created before per-user partitioning have no user_id and belong to the default user
+_OWNER = f"COALESCE(m.user_id, '{DEFAULT_USER_ID}')"
+# Search fallback for short terms; patterns are escaped with _escape_like
+_LIKE_CLAUSE = "s.content LIKE ? ESCAPE '\\'"
+
+async def ensure_metadata_table(db_path: str):
+    async with aiosqlite.connect(db_path) as db:
+        # Lets the background purge hand freed pages back with incremental_vacuum.
+        # Only takes effect on a new database; existing ones are converted
+        # offline with `python maintenance.py vacuum`.
+        await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
         await db.execute("""
             CREATE TABLE IF NOT EXISTS thread_metadata (
                 thread_id TEXT PRIMARY KEY,
@@ -10,21 +22,246 @@ async def ensure_metadata_table():
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
+        # Migration: topic summary used for cheap topic-drift checks (see titles.py)
+        try:
+            await db.execute("SELECT topic_summary FROM thread_metadata LIMIT 1")
+        except aiosqlite.OperationalError:
+            await db.execute("ALTER TABLE thread_metadata ADD COLUMN topic_summary TEXT")
+        # Migration: thread ownership for per-user partitioning (see shards.py)
+        try:
+            await db.execute("SELECT user_id FROM thread_metadata LIMIT 1")
+        except aiosqlite.OperationalError:
+            await db.execute("ALTER TABLE thread_metadata ADD COLUMN user_id TEXT")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_thread_metadata_user ON thread_metadata (user_id, updated_at)")
+        # Threads waiting for background deletion (see deletion.py); hidden from listings
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS deleted_threads (
+                thread_id TEXT PRIMARY KEY,
+                requested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
         await db.commit()
 
-async def save_thread_title(thread_id: str, title: str):
-    async with aiosqlite.connect("checkpoints.db") as db:
+async def ensure_search_index(db_path: str):
+    async with aiosqlite.connect(db_path) as db:
+        # Plain table holding the indexed text; message_search is an external-content
+        # FTS5 index over it. trigram tokenization matches Chinese substrings too.
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS search_messages (
+                id INTEGER PRIMARY KEY,
+                thread_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                role TEXT,
+                content TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
         await db.execute("""
-            INSERT INTO thread_metadata (thread_id, title, updated_at) 
-            VALUES (?, ?, CURRENT_TIMESTAMP)
+            CREATE VIRTUAL TABLE IF NOT EXISTS message_search USING fts5(
+                content,
+                content='search_messages',
+                content_rowid='id',
+                tokenize='trigram'
+            )
+        """)
+        # One row per message, so concurrent indexers of a thread cannot duplicate it
+        try:
+            await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_search_messages_position ON search_messages (thread_id, position)")
+        except aiosqlite.IntegrityError:
+            # Migration: drop duplicates written before the constraint existed
+            await db.execute("""
+                INSERT INTO message_search (message_search, rowid, content)
+                SELECT 'delete', id, content FROM search_messages
+                WHERE id NOT IN (SELECT MIN(id) FROM search_messages GROUP BY thread_id, position)
+            """)
+            await db.execute("""
+                DELETE FROM search_messages
+                WHERE id NOT IN (SELECT MIN(id) FROM search_messages GROUP BY thread_id, position)
+            """)
+            await db.execute("CREATE UNIQUE INDEX idx_search_messages_position ON search_messages (thread_id, position)")
+        await db.execute("DROP INDEX IF EXISTS idx_search_messages_thread")
+        await db.commit()
+
+async def index_thread_messages(db_path: str, thread_id: str, messages, created_at=None):
+    """
+    Add the user/assistant messages of a thread that are not indexed yet.
+    `messages` is the full thread history as schemas.Message objects.
+    """
+    async with aiosqlite.connect(db_path) as db:
+        async with db.execute(
+            "SELECT MAX(position) FROM search_messages WHERE thread_id = ?", (thread_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+        start = row[0] + 1 if row[0] is not None else 0
+
+        for position in range(start, len(messages)):
+            message = messages[position]
+            if message.role not in ("user", "assistant") or not message.content:
+                continue
+            cursor = await db.execute("""
+                INSERT OR IGNORE INTO search_messages (thread_id, position, role, content, created_at)
+                VALUES (?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+            """, (thread_id, position, message.role, message.content, created_at))
+            if cursor.rowcount != 1:
+                # Another indexer (backfill, another worker) got there first
+                continue
+            await db.execute(
+                "INSERT INTO message_search (rowid, content) VALUES (?, ?)",
+                (cursor.lastrowid, message.content)
+            )
+        await db.commit()
+
+async def get_unindexed_threads(db_path: str):
+    async with aiosqlite.connect(db_path) as db:
+        try:
+            async with db.execute("""
+                SELECT DISTINCT thread_id FROM checkpoints
+                WHERE thread_id NOT IN (SELECT DISTINCT thread_id FROM search_messages)
+            """) as cursor:
+                return [row[0] for row in await cursor.fetchall()]
+        except sqlite3.OperationalError as e:
+            if "no such table" in str(e):
+                return []
+            raise
+
+async def search_messages(user_id: str, query: str, limit: int = 20):
+    terms = query.split()
+    if not terms:
+        return []
+    async with aiosqlite.connect(db_path_for(user_id)) as db:
+        if all(len(t) >= 3 for t in terms):
+            # Every term quoted as a phrase, implicitly AND-ed
+            fts_query = " ".join('"' + t.replace('"', '""') + '"' for t in terms)
+            sql = f"""
+                SELECT s.thread_id, m.title, s.role, s.created_at,
+                       snippet(message_search, 0, '<mark>', '</mark>', '…', 32), bm25(message_search)
+                FROM message_search
+                JOIN search_messages s ON s.id = message_search.rowid
+                LEFT JOIN thread_metadata m ON m.thread_id = s.thread_id
+                WHERE message_search MATCH ?
+                  AND {_OWNER} = ?
+                  AND s.thread_id NOT IN (SELECT thread_id FROM deleted_threads)
+                ORDER BY bm25(message_search)
+                LIMIT ?
+            """
+            params = (fts_query, user_id, limit)
+            highlight = False
+        else:
+            # trigram cannot match terms shorter than 3 characters, fall back to a scan
+            sql = f"""
+                SELECT s.thread_id, m.title, s.role, s.created_at, s.content, NULL
+                FROM search_messages s
+                LEFT JOIN thread_metadata m ON m.thread_id = s.thread_id
+                WHERE {" AND ".join(_LIKE_CLAUSE for _ in terms)}
+                  AND {_OWNER} = ?
+                  AND s.thread_id NOT IN (SELECT thread_id FROM deleted_threads)
+                ORDER BY s.created_at DESC
+                LIMIT ?
+            """
+            params = (*[f"%{_escape_like(t)}%" for t in terms], user_id, limit)
+            highlight = True
+
+        async with db.execute(sql, params) as cursor:
+            rows = await cursor.fetchall()
+        return [
+            {
+                "thread_id": row[0],
+                "title": row[1] or "New Chat",
+                "role": row[2],
+                "created_at": row[3],
+                "snippet": _highlight(row[4], terms) if highlight else row[4],
+                "rank": row[5]
+            }
+            for row in rows
+        ]
+
+def _escape_like(term: str) -> str:
+    # Match % and _ literally, like the FTS path does
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def _highlight(content: str, terms, width: int = 32):
+    lower = content.lower()
+    first = min((lower.find(t.lower()) for t in terms if t.lower() in lower), default=0)
+    start = max(first - width, 0)
+    snippet = content[start:first + width * 2]
+    for t in terms:
+        snippet = re.sub(re.escape(t), lambda m: f"<mark>{m.group()}</mark>", snippet, flags=re.IGNORECASE)
+    return ("…" if start > 0 else "") + snippet + ("…" if first + width * 2 < len(content) else "")
+
+async def save_thread_titles(db_path: str, titles):
+    """Save several (thread_id, title, topic_summary) rows of one shard in one transaction."""
+    async with aiosqlite.connect(db_path) as db:
+        await db.executemany("""
+            INSERT INTO thread_metadata (thread_id, title, topic_summary, updated_at)
+            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
             ON CONFLICT(thread_id) DO UPDATE SET
                 title = excluded.title,
+                topic_summary = excluded.topic_summary,
+                updated_at = CURRENT_TIMESTAMP
+        """, titles)
+        await db.commit()
+
+async def get_thread_metadata(user_id: str, thread_id: str):
+    async with aiosqlite.connect(db_path_for(user_id)) as db:
+        async with db.execute(
+            "SELECT title, topic_summary FROM thread_metadata WHERE thread_id = ?", (thread_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+            if not row:
+                return None
+            return {"title": row[0], "topic_summary": row[1]}
+
+async def touch_thread(user_id: str, thread_id: str):
+    # Bump activity time so the sidebar ordering stays correct when the title is kept
+    async with aiosqlite.connect(db_path_for(user_id)) as db:
+        await db.execute("""
+            INSERT INTO thread_metadata (thread_id, updated_at)
+            VALUES (?, CURRENT_TIMESTAMP)
+            ON CONFLICT(thread_id) DO UPDATE SET
                 updated_at = CURRENT_TIMESTAMP
-        """, (thread_id, title))
+        """, (thread_id,))
         await db.commit()
 
-async def get_all_threads():
-    async with aiosqlite.connect("checkpoints.db") as db:
+async def claim_thread(user_id: str, thread_id: str) -> bool:
+    """
+    Record the owner of a new thread. Returns False if another user owns it or
+    it is waiting for deletion (new checkpoints would be purged mid-conversation).
+    """
+    async with aiosqlite.connect(db_path_for(user_id)) as db:
+        async with db.execute("SELECT 1 FROM deleted_threads WHERE thread_id = ?", (thread_id,)) as cursor:
+            if await cursor.fetchone():
+                return False
+        await db.execute(
+            "INSERT OR IGNORE INTO thread_metadata (thread_id, user_id) VALUES (?, ?)", (thread_id, user_id)
+        )
+        await db.commit()
+        async with db.execute(
+            f"SELECT {_OWNER} FROM thread_metadata m WHERE m.thread_id = ?", (thread_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+    return row[0] == user_id
+
+async def thread_belongs_to(user_id: str, thread_id: str) -> bool:
+    async with aiosqlite.connect(db_path_for(user_id)) as db:
+        # Threads waiting for deletion are already gone as far as callers are concerned
+        async with db.execute("SELECT 1 FROM deleted_threads WHERE thread_id = ?", (thread_id,)) as cursor:
+            if await cursor.fetchone():
+                return False
+        async with db.execute(
+            f"SELECT {_OWNER} FROM thread_metadata m WHERE m.thread_id = ?", (thread_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row:
+            return row[0] == user_id
+        if user_id != DEFAULT_USER_ID:
+            return False
+        # Legacy threads with checkpoints but no metadata belong to the default user;
+        # ids that do not exist at all belong to nobody
+        async with db.execute("SELECT 1 FROM checkpoints WHERE thread_id = ? LIMIT 1", (thread_id,)) as cursor:
+            return await cursor.fetchone() is not None
+
+async def get_all_threads(user_id: str):
+    async with aiosqlite.connect(db_path_for(user_id)) as db:
         try:
             # Join checkpoints with metadata to get title and sorted by latest activity
             # If no title exists, we can return "New Chat" or null
@@ -41,7 +278,7 @@ async def get_all_threads():
             # Get all thread_ids from checkpoints
             # Join with metadata
             
-            query = """
+            query = f"""
             SELECT c.thread_id, m.title, m.updated_at
             FROM (
                 SELECT thread_id, MAX(checkpoint_id) as last_checkpoint
@@ -49,10 +286,12 @@ async def get_all_threads():
                 GROUP BY thread_id
             ) c
             LEFT JOIN thread_metadata m ON c.thread_id = m.thread_id
+            WHERE {_OWNER} = ?
+              AND c.thread_id NOT IN (SELECT thread_id FROM deleted_threads)
             ORDER BY m.updated_at DESC, c.last_checkpoint DESC
             """
             
-            async with db.execute(query) as cursor:
+            async with db.execute(query, (user_id,)) as cursor:
                 rows = await cursor.fetchall()
                 # Return list of dicts
                 return [
@@ -69,20 +308,139 @@ async def get_all_threads():
                 return []
             raise
 
-async def delete_thread(thread_id: str):
-    async with aiosqlite.connect("checkpoints.db") as db:
+async def count_thread_rows(user_id: str, thread_id: str, limit: int):
+    """Number of checkpoint rows of a thread, counting at most `limit`."""
+    async with aiosqlite.connect(db_path_for(user_id)) as db:
+        async with db.execute(
+            "SELECT COUNT(*) FROM (SELECT 1 FROM checkpoints WHERE thread_id = ? LIMIT ?)", (thread_id, limit)
+        ) as cursor:
+            return (await cursor.fetchone())[0]
+
+async def delete_thread(user_id: str, thread_id: str):
+    async with aiosqlite.connect(db_path_for(user_id)) as db:
         # Delete from checkpoints
         await db.execute("DELETE FROM checkpoints WHERE thread_id = ?", (thread_id,))
         await db.execute("DELETE FROM writes WHERE thread_id = ?", (thread_id,))
         # Delete from metadata
         await db.execute("DELETE FROM thread_metadata WHERE thread_id = ?", (thread_id,))
+        await db.execute("DELETE FROM deleted_threads WHERE thread_id = ?", (thread_id,))
+        # Delete from the search index (external content: remove index entries first)
+        await db.execute("""
+            INSERT INTO message_search (message_search, rowid, content)
+            SELECT 'delete', id, content FROM search_messages WHERE thread_id = ?
+        """, (thread_id,))
+        await db.execute("DELETE FROM search_messages WHERE thread_id = ?", (thread_id,))
+        await release_thread_blobs(db, thread_id)
         await db.commit()
     return True
 
-async def delete_all_threads():
-    async with aiosqlite.connect("checkpoints.db") as db:
-        await db.execute("DELETE FROM checkpoints")
-        await db.execute("DELETE FROM writes")
-        await db.execute("DELETE FROM thread_metadata")
+async def mark_threads_deleted(user_id: str, thread_ids=None):
+    """Hide threads immediately; their rows are removed later by the background purge."""
+    async with aiosqlite.connect(db_path_for(user_id)) as db:
+        if thread_ids is None:
+            # All of the user's threads that exist right now
+            await db.execute(f"""
+                INSERT OR IGNORE INTO deleted_threads (thread_id)
+                SELECT m.thread_id FROM thread_metadata m WHERE {_OWNER} = ?
+            """, (user_id,))
+            if user_id == DEFAULT_USER_ID:
+                # Legacy threads that never got a metadata row
+                await db.execute("""
+                    INSERT OR IGNORE INTO deleted_threads (thread_id)
+                    SELECT DISTINCT thread_id FROM checkpoints
+                    WHERE thread_id NOT IN (SELECT thread_id FROM thread_metadata)
+                """)
+        else:
+            await db.executemany(
+                "INSERT OR IGNORE INTO deleted_threads (thread_id) VALUES (?)",
+                [(thread_id,) for thread_id in thread_ids]
+            )
         await db.commit()
     return True
+
+async def count_deleted_threads(user_id: str) -> int:
+    """Number of the user's threads still waiting for the background purge."""
+    async with aiosqlite.connect(db_path_for(user_id)) as db:
+        async with db.execute(f"""
+            SELECT COUNT(*) FROM deleted_threads d
+            LEFT JOIN thread_metadata m ON m.thread_id = d.thread_id
+            WHERE {_OWNER} = ?
+        """, (user_id,)) as cursor:
+            return (await cursor.fetchone())[0]
+
+async def get_deleted_threads(db_path: str):
+    async with aiosqlite.connect(db_path) as db:
+        async with db.execute("SELECT thread_id FROM deleted_threads ORDER BY requested_at") as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+async def purge_thread_batch(db_path: str, thread_id: str, batch_size: int) -> int:
+    """
+    Delete up to batch_size rows of a deleted thread in one short transaction.
+    Returns the number of rows removed; 0 means the thread is fully purged.
+    """
+    async with aiosqlite.connect(db_path) as db:
+        for table in ("checkpoints", "writes"):
+            cursor = await db.execute(f"""
+                DELETE FROM {table} WHERE rowid IN (
+                    SELECT rowid FROM {table} WHERE thread_id = ? LIMIT ?
+                )
+            """, (thread_id, batch_size))
+            if cursor.rowcount:
+                await db.commit()
+                return cursor.rowcount
+
+        async with db.execute(
+            "SELECT id FROM search_messages WHERE thread_id = ? LIMIT ?", (thread_id, batch_size)
+        ) as cursor:
+            ids = [row[0] for row in await cursor.fetchall()]
+        if ids:
+            placeholders = ",".join("?" * len(ids))
+            # External content index: remove index entries before their rows
+            await db.execute(f"""
+                INSERT INTO message_search (message_search, rowid, content)
+                SELECT 'delete', id, content FROM search_messages WHERE id IN ({placeholders})
+            """, ids)
+            await db.execute(f"DELETE FROM search_messages WHERE id IN ({placeholders})", ids)
+        else:
+            await db.execute("DELETE FROM thread_metadata WHERE thread_id = ?", (thread_id,))
+            await db.execute("DELETE FROM deleted_threads WHERE thread_id = ?", (thread_id,))
+            await release_thread_blobs(db, thread_id)
+        await db.commit()
+        return len(ids)
+
+async def incremental_vacuum(db_path: str, pages: int):
+    async with aiosqlite.connect(db_path) as db:
+        # The pragma frees one page per step, so the cursor has to be drained
+        async with db.execute(f"PRAGMA incremental_vacuum({int(pages)})") as cursor:
+            await cursor.fetchall()
+
+async def auto_vacuum_mode(db_path: str) -> int:
+    """0 = none, 1 = full, 2 = incremental."""
+    async with aiosqlite.connect(db_path) as db:
+        async with db.execute("PRAGMA auto_vacuum") as cursor:
+            return (await cursor.fetchone())[0]
+
+async def convert_to_incremental_vacuum(db_path: str):
+    """Rewrite the whole file so the purge can return freed pages. Needs exclusive access."""
+    async with aiosqlite.connect(db_path) as db:
+        await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        await db.execute("VACUUM")
+
+async def release_thread_blobs(db, thread_id: str):
+    """Drop a deleted thread's blob references and the blobs no other thread uses."""
+    await db.execute("""
+        DELETE FROM search_blobs
+        WHERE hash IN (SELECT hash FROM search_blob_refs WHERE thread_id = ?)
+          AND hash NOT IN (SELECT hash FROM search_blob_refs WHERE thread_id != ?)
+    """, (thread_id, thread_id))
+    await db.execute("DELETE FROM search_blob_refs WHERE thread_id = ?", (thread_id,))
+
+async def clear_orphaned_blobs(db_path: str):
+    # Blobs stored before search_blob_refs existed have no references;
+    # they can only be dropped once the shard has no threads left at all
+    async with aiosqlite.connect(db_path) as db:
+        async with db.execute("SELECT 1 FROM checkpoints LIMIT 1") as cursor:
+            if await cursor.fetchone() is None:
+                await db.execute("DELETE FROM search_blobs")
+                await db.execute("DELETE FROM search_blob_refs")
+        await db.commit()
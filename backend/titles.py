@@ -0,0 +1,146 @@
+import asyncio
+import json
+from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
+
+from llm import llm
+from store import get_thread_metadata, save_thread_titles, touch_thread
+from shards import db_path_for
+from utils import tokenize
+
+# A thread is re-titled only when the new user question shares (almost) no content
+# words with the current title and the question it was generated from. Calibrated
+# on hand-labelled follow-ups: same-topic questions scored 0.29-0.88 (two with no
+# shared word scored 1.0), unrelated questions all scored 1.0.
+TOPIC_DRIFT_THRESHOLD = 0.95
+# Characters of an exchange sent to the LLM / of a question kept as the topic summary
+EXCHANGE_CHARS = 600
+
+# Words that say nothing about the topic. CJK bigrams containing one of the
+# function characters are dropped too (一个, 可以, 我们, 什么 ...).
+_STOPWORDS = {
+    "a", "about", "an", "and", "any", "are", "as", "at", "be", "between", "by", "can", "could",
+    "did", "difference", "do", "does", "example", "explain", "for", "from", "get", "how", "i",
+    "if", "in", "is", "it", "me", "more", "my", "not", "of", "on", "or", "should", "so", "some",
+    "that", "the", "there", "this", "to", "use", "was", "we", "were", "what", "when", "which",
+    "who", "why", "with", "would", "you",
+    "学习", "推荐", "问题", "解释", "区别", "意思", "例子", "知道", "告诉",
+}
+_FUNCTION_CHARS = set("的了是吗呢吧我你他她它们在和与有这那么什怎个一不也就都要会能请下把被给对啊呀还又很再些哪为如果该让想用可以")
+# Pending title jobs are collected for this long and sent in a single LLM request
+# per user (conversations of different users never share a prompt)
+TITLE_BATCH_WINDOW = 2.0
+TITLE_BATCH_SIZE = 8
+
+_pending = {}  # (user_id, thread_id) -> (question, exchange text), latest wins
+_wakeup = None
+_worker_task = None
+
+def last_question(messages) -> str:
+    for m in reversed(messages):
+        if isinstance(m, HumanMessage):
+            return str(m.content)[:EXCHANGE_CHARS]
+    return ""
+
+def last_exchange(messages) -> str:
+    """Text of the latest user message and the reply that followed it."""
+    user_text, reply_text = "", ""
+    for m in reversed(messages):
+        if isinstance(m, AIMessage) and not reply_text and not user_text:
+            reply_text = str(m.content)
+        elif isinstance(m, HumanMessage):
+            user_text = str(m.content)
+            break
+    return f"{user_text}\n{reply_text}"[:EXCHANGE_CHARS]
+
+def topic_terms(text: str):
+    return {
+        t for t in tokenize(text)
+        if len(t) > 1 and t not in _STOPWORDS and not any(ch in _FUNCTION_CHARS for ch in t)
+    }
+
+def topic_drift(question: str, title: str, summary: str) -> float:
+    """
+    Share of the question's content words missing from the current title and
+    summary: 1.0 means nothing in common, 0.0 means all of them appear.
+    Answers are left out, their generic vocabulary overlaps with almost anything.
+    """
+    new_terms = topic_terms(question)
+    if not new_terms:
+        # Nothing but filler ("好的，谢谢"), keep the current title
+        return 0.0
+    ref_terms = topic_terms(f"{title or ''} {summary or ''}")
+    return 1.0 - len(new_terms & ref_terms) / len(new_terms)
+
+async def update_thread_title(user_id: str, thread_id: str, messages):
+    """Queue a title job on the first exchange or when the topic has drifted."""
+    if not messages:
+        return
+    question = last_question(messages)
+    metadata = await get_thread_metadata(user_id, thread_id)
+    if metadata and metadata["title"]:
+        if topic_drift(question, metadata["title"], metadata["topic_summary"]) < TOPIC_DRIFT_THRESHOLD:
+            await touch_thread(user_id, thread_id)
+            return
+    enqueue_title(user_id, thread_id, question, last_exchange(messages))
+
+def enqueue_title(user_id: str, thread_id: str, question: str, exchange: str):
+    global _wakeup, _worker_task
+    _pending[(user_id, thread_id)] = (question, exchange)
+    if _worker_task is None or _worker_task.done():
+        _wakeup = asyncio.Event()
+        _worker_task = asyncio.create_task(_title_worker())
+    _wakeup.set()
+
+async def _title_worker():
+    while True:
+        await _wakeup.wait()
+        if len(_pending) < TITLE_BATCH_SIZE:
+            await asyncio.sleep(TITLE_BATCH_WINDOW)
+        _wakeup.clear()
+        await flush_titles()
+
+async def flush_titles():
+    while _pending:
+        user_id = next(iter(_pending))[0]
+        keys = [key for key in _pending if key[0] == user_id][:TITLE_BATCH_SIZE]
+        batch = [(thread_id, _pending.pop((user_id, thread_id))) for _, thread_id in keys]
+        try:
+            titles = await generate_titles(batch)
+            # The question is kept as topic summary for later drift checks
+            rows = [(thread_id, titles[thread_id], question) for thread_id, (question, _) in batch if titles.get(thread_id)]
+            await save_thread_titles(db_path_for(user_id), rows)
+        except Exception as e:
+            print(f"Error generating title: {e}")
+
+async def generate_titles(batch):
+    """Title several threads of one user with one LLM call. Returns {thread_id: title}."""
+    conversations = "\n\n".join(
+        f"[{i}]\n{exchange}" for i, (_, (_, exchange)) in enumerate(batch, start=1)
+    )
+    prompt = f"""
+    请为以下每段对话分别生成一个简短的标题（不超过 10 个字）。
+    如果是中文对话，请使用中文标题。
+    只输出一个 JSON 对象，键为对话编号，值为标题，例如 {{"1": "标题"}}。
+
+    对话内容：
+    {conversations}
+    """
+    response = await llm.ainvoke([SystemMessage(content=prompt)])
+    text = response.content.strip()
+    # Models sometimes wrap JSON in a markdown code block
+    text = text[text.find("{"):text.rfind("}") + 1]
+    numbered = json.loads(text)
+
+    titles = {}
+    for i, (thread_id, _) in enumerate(batch, start=1):
+        title = str(numbered.get(str(i), "")).strip().replace('"', '').replace("'", "")
+        if title:
+            titles[thread_id] = title
+    return titles
+
+async def stop_title_worker():
+    global _worker_task
+    if _worker_task and not _worker_task.done():
+        _worker_task.cancel()
+    _worker_task = None
+    await flush_titles()
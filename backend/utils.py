@@ -1,3 +1,4 @@
+import re
 from typing import List
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, BaseMessage
 from schemas import Message
@@ -25,3 +26,31 @@ def map_from_langchain_messages(messages: List[BaseMessage]) -> List[Message]:
             role = "user"
         result.append(Message(role=role, content=str(m.content)))
     return result
+
+# Matches runs of latin letters/digits and single CJK characters.
+# Chinese text has no spaces, so CJK characters are turned into bigrams below.
+_TOKEN_RE = re.compile(r"[a-z0-9_+#]+|[一-鿿]")
+
+def tokenize(text: str) -> List[str]:
+    """Cheap local tokenizer used for lexical scoring (no external services)."""
+    tokens = []
+    cjk_run = []
+    last_end = -1
+    for match in _TOKEN_RE.finditer((text or "").lower()):
+        token = match.group()
+        is_cjk = "一" <= token[0] <= "鿿"
+        if not is_cjk or match.start() != last_end:
+            tokens.extend(_cjk_bigrams(cjk_run))
+            cjk_run = []
+        last_end = match.end()
+        if is_cjk:
+            cjk_run.append(token)
+        else:
+            tokens.append(token)
+    tokens.extend(_cjk_bigrams(cjk_run))
+    return tokens
+
+def _cjk_bigrams(chars: List[str]) -> List[str]:
+    if len(chars) == 1:
+        return chars
+    return [chars[i] + chars[i + 1] for i in range(len(chars) - 1)]
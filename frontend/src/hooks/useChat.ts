@@ -170,19 +170,22 @@ export function useChat() {
     try {
       const currentMessages = conversations[currentId]?.messages || [];
 
-      const response = await fetch(`${API_BASE_URL}/chat/stream`, {
+      // The backend journals every turn under turnId, so re-posting the same turn
+      // resumes it from Last-Event-ID instead of running the question again.
+      const turnId = crypto.randomUUID();
+      let lastEventId = 0;
+      const openStream = () => fetch(`${API_BASE_URL}/chat/stream`, {
         method: "POST",
-        headers: { "Content-Type": "application/json" },
+        headers: {
+          "Content-Type": "application/json",
+          ...(lastEventId ? { "Last-Event-ID": String(lastEventId) } : {}),
+        },
         body: JSON.stringify({
           messages: [...currentMessages, userMessage],
           thread_id: currentId,
+          turn_id: turnId,
         }),
       });
-
-      if (!response.body) throw new Error("No response body");
-      
-      const reader = response.body.getReader();
-      const decoder = new TextDecoder();
       
       // Add empty assistant message
       setConversations(prev => {
@@ -202,72 +205,105 @@ export function useChat() {
       let accumulatedDraft = "";
       let accumulatedSearch = "";
 
-      while (true) {
-        const { done, value } = await reader.read();
-        if (done) {
-            fetchThreads();
-            fetchProfile();
-            break;
-        }
+      // Returns true once the turn is finished
+      const handleData = (data: string) => {
+        if (data === "[DONE]") return true;
 
-        const chunk = decoder.decode(value, { stream: true });
-        const lines = chunk.split("\n\n");
+        try {
+          const parsed = JSON.parse(data);
+          const node = parsed.node;
+          const content = parsed.content;
+          const type = parsed.type;
 
-        for (const line of lines) {
-          if (line.startsWith("data: ")) {
-            const data = line.slice(6);
-            if (data === "[DONE]") break;
+          if (type === "revision_start") {
+             if (node === "coach_draft") accumulatedDraft += "\n\n---\n**New Revision**\n---\n\n";
+             else if (node === "critic") accumulatedCritic += "\n\n---\n**New Revision**\n---\n\n";
+             return false;
+          }
 
-            try {
-              const parsed = JSON.parse(data);
-              const node = parsed.node;
-              const content = parsed.content;
-              const type = parsed.type;
+          if (content) {
+            if (node === "coach") accumulatedContent += content;
+            else if (node === "coach_draft") accumulatedDraft += content;
+            else if (node === "critic") accumulatedCritic += content;
+            else if (node === "mentor") accumulatedMentor += content;
+            else if (node === "search") accumulatedSearch += content;
 
-              if (type === "revision_start") {
-                 if (node === "coach_draft") accumulatedDraft += "\n\n---\n**New Revision**\n---\n\n";
-                 else if (node === "critic") accumulatedCritic += "\n\n---\n**New Revision**\n---\n\n";
-                 continue;
+            setConversations(prev => {
+              const prevConv = prev[currentId];
+              if (!prevConv) return prev;
+
+              const newMessages = [...prevConv.messages];
+              const lastMsgIndex = newMessages.length - 1;
+              const lastMsg = { ...newMessages[lastMsgIndex] };
+              newMessages[lastMsgIndex] = lastMsg;
+              
+              if (lastMsg.role === "assistant") {
+                if (node === "coach") lastMsg.content = accumulatedContent;
+                else if (node === "coach_draft") {
+                    lastMsg.details = { ...lastMsg.details, draft: accumulatedDraft };
+                } else if (node === "critic") {
+                    lastMsg.details = { ...lastMsg.details, critic: accumulatedCritic };
+                } else if (node === "mentor") {
+                    lastMsg.details = { ...lastMsg.details, mentor: accumulatedMentor };
+                } else if (node === "search") {
+                    lastMsg.details = { ...lastMsg.details, search: accumulatedSearch };
+                }
               }
+              
+              return { ...prev, [currentId]: { ...prevConv, messages: newMessages } };
+            });
+          }
+        } catch (e) {
+          console.error("Error parsing SSE data:", e);
+        }
+        return false;
+      };
 
-              if (content) {
-                if (node === "coach") accumulatedContent += content;
-                else if (node === "coach_draft") accumulatedDraft += content;
-                else if (node === "critic") accumulatedCritic += content;
-                else if (node === "mentor") accumulatedMentor += content;
-                else if (node === "search") accumulatedSearch += content;
-
-                setConversations(prev => {
-                  const prevConv = prev[currentId];
-                  if (!prevConv) return prev;
-
-                  const newMessages = [...prevConv.messages];
-                  const lastMsgIndex = newMessages.length - 1;
-                  const lastMsg = { ...newMessages[lastMsgIndex] };
-                  newMessages[lastMsgIndex] = lastMsg;
-                  
-                  if (lastMsg.role === "assistant") {
-                    if (node === "coach") lastMsg.content = accumulatedContent;
-                    else if (node === "coach_draft") {
-                        lastMsg.details = { ...lastMsg.details, draft: accumulatedDraft };
-                    } else if (node === "critic") {
-                        lastMsg.details = { ...lastMsg.details, critic: accumulatedCritic };
-                    } else if (node === "mentor") {
-                        lastMsg.details = { ...lastMsg.details, mentor: accumulatedMentor };
-                    } else if (node === "search") {
-                        lastMsg.details = { ...lastMsg.details, search: accumulatedSearch };
-                    }
-                  }
-                  
-                  return { ...prev, [currentId]: { ...prevConv, messages: newMessages } };
-                });
+      const decoder = new TextDecoder();
+      let finished = false;
+      let attempts = 0;
+
+      while (!finished && attempts < 5) {
+        try {
+          const response = await openStream();
+          if (response.status === 410) {
+            // The turn finished but can no longer be replayed, its answer is in the thread history
+            const res = await fetch(`${API_BASE_URL}/chat/history/${currentId}`);
+            const data = await res.json();
+            updateConversation(currentId, { messages: data.messages });
+            finished = true;
+            break;
+          }
+          if (!response.ok || !response.body) throw new Error(`Stream failed: ${response.status}`);
+          const reader = response.body.getReader();
+          let buffer = "";
+
+          while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+
+            buffer += decoder.decode(value, { stream: true });
+            const events = buffer.split("\n\n");
+            buffer = events.pop() || "";
+
+            for (const event of events) {
+              for (const line of event.split("\n")) {
+                if (line.startsWith("id: ")) lastEventId = Number(line.slice(4));
+                else if (line.startsWith("data: ") && handleData(line.slice(6))) finished = true;
               }
-            } catch (e) {
-              console.error("Error parsing SSE data:", e);
             }
           }
+          // A stream that ends without [DONE] was cut off, resume it
+          if (!finished) throw new Error("Stream ended early");
+        } catch (err) {
+          attempts += 1;
+          if (attempts >= 5) throw err;
+          await new Promise(resolve => setTimeout(resolve, 1000 * attempts));
         }
       }
+
+      fetchThreads();
+      fetchProfile();
     } catch (error) {
       console.error("Error sending message:", error);
     } finally {